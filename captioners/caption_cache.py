@@ -0,0 +1,125 @@
+"""
+Persistent on-disk cache of caption responses.
+
+Entries are keyed by a SHA-256 over the image bytes, the prompt text and the
+model name, so re-running a captioner after a crash or over mostly unchanged
+data returns earlier captions without calling the API again. Changing the
+prompt or the model naturally misses the cache.
+
+Each entry is one small text file. When the cache grows past max_bytes, the
+least recently used entries (by file mtime, refreshed on every hit) are
+deleted until it fits again.
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "triplex", "captions")
+DEFAULT_MAX_BYTES = 1024 ** 3
+
+
+class CaptionCache:
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # key -> size in bytes, least recently used first
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._scan()
+
+    @staticmethod
+    def make_key(images, prompt, model_name):
+        """
+        Build a cache key.
+
+        Args:
+            images (list): Image payloads as bytes or (base64) strings, in request order.
+            prompt (str): All prompt text sent with the images.
+            model_name (str): Model that produced (or will produce) the caption.
+        """
+        sha = hashlib.sha256()
+        for image in images:
+            data = image.encode("utf-8") if isinstance(image, str) else bytes(image)
+            sha.update(hashlib.sha256(data).digest())
+        sha.update(b"\0prompt\0" + prompt.encode("utf-8"))
+        sha.update(b"\0model\0" + model_name.encode("utf-8"))
+        return sha.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".txt")
+
+    def _scan(self):
+        found = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith(".txt"):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                found.append((stat.st_mtime, name[:-4], stat.st_size))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self._total_bytes += size
+
+    def _read(self, key):
+        # Caller holds the lock.
+        if key not in self._entries:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                text = f.read()
+            os.utime(path)
+        except OSError:
+            self._total_bytes -= self._entries.pop(key)
+            return None
+        self._entries.move_to_end(key)
+        return text
+
+    def get(self, *keys):
+        """Return the cached caption for the first of keys that is present, or None."""
+        with self._lock:
+            for key in keys:
+                text = self._read(key)
+                if text is not None:
+                    self.hits += 1
+                    return text
+            self.misses += 1
+            return None
+
+    def put(self, key, text):
+        """Store a caption, then evict least recently used entries beyond max_bytes."""
+        path = self._path(key)
+        data = text.encode("utf-8")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temp file and rename so a crash never leaves a truncated entry.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            if key in self._entries:
+                self._total_bytes -= self._entries.pop(key)
+            self._entries[key] = len(data)
+            self._total_bytes += len(data)
+            while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+                old_key, size = self._entries.popitem(last=False)
+                self._total_bytes -= size
+                try:
+                    os.remove(self._path(old_key))
+                except OSError:
+                    pass
+
+    def summary(self):
+        return (f"Caption cache: {self.hits} hits, {self.misses} misses, "
+                f"{len(self._entries)} entries ({self._total_bytes / 1024 ** 2:.1f} MB) in {self.cache_dir}")
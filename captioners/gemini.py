@@ -1,17 +1,30 @@
 import argparse
+import asyncio
 import base64
 import concurrent.futures
+import copy
+import hashlib
+import itertools
 import json
+import math
+import multiprocessing
 import os
 import shutil
 import sys
+import threading
+import types
 
 import cv2
 import google.generativeai as genai
+import numpy as np
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
 
 from dotenv import load_dotenv
 
+from caption_cache import DEFAULT_CACHE_DIR, CaptionCache
+from image_payload import IMAGE_FORMATS, PayloadEncoder
+from rate_limiter import ModelHealth, RateLimiter, is_rate_limit_error
+
 load_dotenv()
 
 # --- FALLBACK MODEL LISTS ---
@@ -42,8 +55,68 @@ safety_settings = {
     HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE
 }
 
+REWRITE_MODEL = "gemini-1.5-flash-latest"
 
-def rewrite_composite_caption(composite_caption):
+# Shared by every file and frame worker so the total number of in-flight requests
+# per model stays within what the API accepts. Limits are set from the CLI in main().
+rate_limiter = RateLimiter()
+
+# Shared view of which models are currently rate limited, so call_gemini can skip
+# them instead of retrying each exhausted model on every frame.
+model_health = ModelHealth()
+
+_model_cache = {}
+_model_cache_lock = threading.Lock()
+
+# On-disk cache of caption responses; set from the CLI in main(), None disables it.
+caption_cache = None
+
+# Resizes and encodes frames for upload and reuses their base64 across retries; set from the CLI in main().
+payload_encoder = PayloadEncoder("gemini")
+
+
+def cache_keys_for(inputs, model_list):
+    # One key per model over the request's image data and prompt text, in fallback order.
+    if caption_cache is None:
+        return {}
+    images = [part["data"] for part in inputs if isinstance(part, dict)]
+    prompt = "\n".join(part for part in inputs if isinstance(part, str))
+    return {model_name: CaptionCache.make_key(images, prompt, model_name) for model_name in model_list}
+
+
+def store_cached_caption(cache_keys, model_name, text):
+    if caption_cache is not None and model_name in cache_keys:
+        caption_cache.put(cache_keys[model_name], text)
+
+
+async def get_cached_caption_async(inputs, model_list):
+    # Hashing the payload and reading (and touching) cache files happens off the event loop.
+    # Returns (cache_keys, cached caption or None).
+    if caption_cache is None:
+        return {}, None
+    loop = asyncio.get_running_loop()
+    cache_keys = await loop.run_in_executor(None, cache_keys_for, inputs, model_list)
+    cached = await loop.run_in_executor(None, caption_cache.get, *cache_keys.values())
+    return cache_keys, cached
+
+
+async def store_cached_caption_async(cache_keys, model_name, text):
+    # put() writes a file and may evict old entries, so it also runs off the event loop.
+    if caption_cache is not None and model_name in cache_keys:
+        await asyncio.get_running_loop().run_in_executor(None, store_cached_caption, cache_keys, model_name, text)
+
+
+def get_model(model_name):
+    # GenerativeModel objects are reusable; build each one once instead of per call.
+    with _model_cache_lock:
+        model = _model_cache.get(model_name)
+        if model is None:
+            model = genai.GenerativeModel(model_name=model_name)
+            _model_cache[model_name] = model
+        return model
+
+
+def build_rewriting_prompt(composite_caption):
     # Build a rewriting prompt that asks the model to reframe the caption.
     # IMPORTANT: The rewritten caption must keep all the scene details but avoid redundant phrases.
     rewriting_prompt = (
@@ -60,51 +133,140 @@ def rewrite_composite_caption(composite_caption):
             {composite_caption}
             """
     )
+    return rewriting_prompt
+
+
+def rewrite_composite_caption(composite_caption):
+    rewriting_prompt = build_rewriting_prompt(composite_caption)
+
+    cache_keys = cache_keys_for([rewriting_prompt], [REWRITE_MODEL])
+    if cache_keys:
+        cached = caption_cache.get(*cache_keys.values())
+        if cached is not None:
+            return cached
 
     # Call the gemini-1.5-flash model using the rewriting prompt.
-    model = genai.GenerativeModel(model_name="gemini-1.5-flash-latest")
-    result = model.generate_content([rewriting_prompt], generation_config=None)
+    model = get_model(REWRITE_MODEL)
+    rate_limiter.acquire(REWRITE_MODEL)
+    outcome = "error"
+    try:
+        result = model.generate_content([rewriting_prompt], generation_config=None)
+        outcome = "ok"
+    except Exception as e:
+        if is_rate_limit_error(e):
+            outcome = "rate_limited"
+        raise
+    finally:
+        rate_limiter.release(REWRITE_MODEL, outcome)
 
     if result and result.text:
+        store_cached_caption(cache_keys, REWRITE_MODEL, result.text)
+        return result.text
+    else:
+        raise Exception("Failed to rewrite composite caption.")
+
+
+async def rewrite_composite_caption_async(composite_caption):
+    rewriting_prompt = build_rewriting_prompt(composite_caption)
+    cache_keys, cached = await get_cached_caption_async([rewriting_prompt], [REWRITE_MODEL])
+    if cached is not None:
+        return cached
+
+    model = get_model(REWRITE_MODEL)
+    await rate_limiter.acquire_async(REWRITE_MODEL)
+    outcome = "error"
+    try:
+        result = await model.generate_content_async([rewriting_prompt], generation_config=None)
+        outcome = "ok"
+    except Exception as e:
+        if is_rate_limit_error(e):
+            outcome = "rate_limited"
+        raise
+    finally:
+        rate_limiter.release(REWRITE_MODEL, outcome)
+
+    if result and result.text:
+        await store_cached_caption_async(cache_keys, REWRITE_MODEL, result.text)
         return result.text
     else:
         raise Exception("Failed to rewrite composite caption.")
 
 
 def call_gemini(inputs, generation_config, model_list):
-    for model_name in model_list:
+    cache_keys = cache_keys_for(inputs, model_list)
+    if cache_keys:
+        cached = caption_cache.get(*cache_keys.values())
+        if cached is not None:
+            return cached
+
+    for model_name in model_health.route(model_list):
+        rate_limiter.acquire(model_name)
+        outcome = "error"
         try:
             print(f"Calling Gemini model {model_name} …")
-            model = genai.GenerativeModel(model_name=model_name)
+            model = get_model(model_name)
             result = model.generate_content(
                 inputs,
                 generation_config=generation_config,
                 safety_settings=safety_settings
             )
+            outcome = "ok"
+            model_health.mark_healthy(model_name)
             if result and result.text:
+                store_cached_caption(cache_keys, model_name, result.text)
                 return result.text
         except Exception as e:
-            err_str = str(e).lower()
-            if "resource_exhausted" in err_str or "rate limit" in err_str:
+            if is_rate_limit_error(e):
+                outcome = "rate_limited"
+                model_health.mark_rate_limited(model_name)
                 print(f"Rate limit hit for model {model_name}. Trying next model.")
                 continue
             else:
                 print(f"Error using model {model_name}: {e}")
                 continue
+        finally:
+            rate_limiter.release(model_name, outcome)
     raise Exception("All fallback models failed (likely all rate limited).")
 
 
-def get_frame_caption(image_bytes, timestamp, model_list, custom_prompt=""):
-    # Build the image input
-    image_input = {
-        "mime_type": "image/jpeg",
-        "data": base64.b64encode(image_bytes).decode('utf-8')
-    }
-    # Default prompt instructions for this frame.
-    default_prompt = f"""
-    You are a detailed visual description expert. For the provided video frame at timestamp {timestamp} seconds, generate a caption in Markdown format that adheres to the following rules:
+async def call_gemini_async(inputs, generation_config, model_list):
+    # Same fallback, health routing and caching as call_gemini, using the async generate API.
+    cache_keys, cached = await get_cached_caption_async(inputs, model_list)
+    if cached is not None:
+        return cached
 
-    • Include an entry for every visible person or discernible human element.  
+    for model_name in await model_health.route_async(model_list):
+        await rate_limiter.acquire_async(model_name)
+        outcome = "error"
+        try:
+            print(f"Calling Gemini model {model_name} …")
+            model = get_model(model_name)
+            result = await model.generate_content_async(
+                inputs,
+                generation_config=generation_config,
+                safety_settings=safety_settings
+            )
+            outcome = "ok"
+            model_health.mark_healthy(model_name)
+            if result and result.text:
+                await store_cached_caption_async(cache_keys, model_name, result.text)
+                return result.text
+        except Exception as e:
+            if is_rate_limit_error(e):
+                outcome = "rate_limited"
+                model_health.mark_rate_limited(model_name)
+                print(f"Rate limit hit for model {model_name}. Trying next model.")
+                continue
+            else:
+                print(f"Error using model {model_name}: {e}")
+                continue
+        finally:
+            rate_limiter.release(model_name, outcome)
+    raise Exception("All fallback models failed (likely all rate limited).")
+
+
+# Caption rules and output schema shared by the single-frame and batched frame prompts.
+FRAME_CAPTION_RULES = """    • Include an entry for every visible person or discernible human element.  
       – Describe each person's appearance, attire, pose, any accessories, and any visible nudity.  
       – Use everyday terms for body parts (e.g., 'butt' instead of 'buttocks') and avoid overly technical or scientific language.  
       – If a female subject’s upper chest is visible, refer to it as “breasts.”  
@@ -115,33 +277,315 @@ def get_frame_caption(image_bytes, timestamp, model_list, custom_prompt=""):
     • If you have custom instructions (e.g., mention a specific pose or detail), integrate them seamlessly.  
     
     Return the final output as a structured Markdown block matching the basic schema:
-    {{
+    {
     "persons": [...],
       "location": ...,
       "scene_description": ...,
       "movement": ...
-    }}
+    }
     (or a similar format). 
-    """
+"""
+
+# Batched frame requests ask for JSON so each frame's caption can be split back out.
+BATCH_GENERATION_CONFIG = {"response_mime_type": "application/json"}
+
+
+def make_image_input(image_bytes, mime_type=None):
+    return {
+        "mime_type": mime_type or payload_encoder.mime_type,
+        "data": payload_encoder.to_base64(image_bytes)
+    }
+
+
+def build_frame_inputs(image_bytes, timestamp, custom_prompt=""):
+    # Build the image input
+    image_input = make_image_input(image_bytes)
+    # Default prompt instructions for this frame.
+    default_prompt = f"""
+    You are a detailed visual description expert. For the provided video frame at timestamp {timestamp} seconds, generate a caption in Markdown format that adheres to the following rules:
+
+{FRAME_CAPTION_RULES}    """
     # If the user provided extra instructions, append them to the default prompt.
     if custom_prompt:
         default_prompt += "\nAdditional instructions: " + custom_prompt.strip() + "\n"
     inputs = [image_input, default_prompt]
+    return inputs, image_input
+
+
+def get_frame_caption(image_bytes, timestamp, model_list, custom_prompt=""):
+    inputs, image_input = build_frame_inputs(image_bytes, timestamp, custom_prompt)
     result_text = call_gemini(inputs, generation_config=None, model_list=model_list)
     return (result_text, image_input)
 
 
-def get_composite_caption(frame_data_list, composite_model_list, custom_prompt=""):
+async def get_frame_caption_async(image_bytes, timestamp, model_list, custom_prompt=""):
+    inputs, image_input = build_frame_inputs(image_bytes, timestamp, custom_prompt)
+    result_text = await call_gemini_async(inputs, generation_config=None, model_list=model_list)
+    return (result_text, image_input)
+
+
+def build_frame_batch_inputs(frames, custom_prompt=""):
+    # frames is a list of (timestamp, image_bytes). Each image is labelled with its
+    # position and timestamp so the response can be mapped back frame by frame.
+    inputs = []
+    image_inputs = []
+    for i, (timestamp, image_bytes) in enumerate(frames, 1):
+        image_input = make_image_input(image_bytes)
+        inputs.append(f"Frame {i} at {timestamp}s:")
+        inputs.append(image_input)
+        image_inputs.append(image_input)
+    batch_prompt = f"""
+    You are a detailed visual description expert. You are given {len(frames)} video frames, each labelled with its frame number and timestamp. Caption every frame separately; for each caption, follow these rules:
+
+{FRAME_CAPTION_RULES}
+    Return a JSON array with exactly one object per frame, in frame order, each with the keys "frame" (the frame number) and "caption" (that frame's caption as a Markdown string). Do not merge frames or skip any.
+    """
+    if custom_prompt:
+        batch_prompt += "\nAdditional instructions: " + custom_prompt.strip() + "\n"
+    inputs.append(batch_prompt)
+    return inputs, image_inputs
+
+
+def parse_batch_captions(result_text, frame_count):
+    # Map a batched JSON response to a list of captions (None where a frame is missing).
+    text = result_text.strip()
+    if text.startswith("```"):
+        text = text.strip("`")
+        text = text[text.find("\n") + 1:] if "\n" in text else text
+    try:
+        items = json.loads(text)
+    except ValueError:
+        return [None] * frame_count
+    if isinstance(items, dict):
+        items = items.get("frames") or items.get("captions") or []
+    captions = [None] * frame_count
+    for position, item in enumerate(items if isinstance(items, list) else []):
+        if not isinstance(item, dict) or not item.get("caption"):
+            continue
+        try:
+            index = int(item.get("frame", position + 1)) - 1
+        except (TypeError, ValueError):
+            index = position
+        if 0 <= index < frame_count and captions[index] is None:
+            caption = item["caption"]
+            captions[index] = caption if isinstance(caption, str) else json.dumps(caption, indent=2)
+    return captions
+
+
+def caption_frames(frames, model_list, custom_prompt=""):
+    """
+    Caption a list of (timestamp, image_bytes) frames.
+
+    A single frame uses the regular per-frame request. Several frames are sent in
+    one request; any frame missing from the batched answer is retried on its own.
+    Returns a list of (timestamp, (caption, image_input)) or (timestamp, exception).
+    """
+    if len(frames) == 1:
+        timestamp, image_bytes = frames[0]
+        try:
+            return [(timestamp, get_frame_caption(image_bytes, timestamp, model_list, custom_prompt))]
+        except Exception as err:
+            return [(timestamp, err)]
+
+    captions = [None] * len(frames)
+    image_inputs = [None] * len(frames)
+    try:
+        inputs, image_inputs = build_frame_batch_inputs(frames, custom_prompt)
+        result_text = call_gemini(inputs, generation_config=BATCH_GENERATION_CONFIG, model_list=model_list)
+        captions = parse_batch_captions(result_text, len(frames))
+    except Exception as err:
+        print(f"Batched frame request failed, captioning frames one by one: {err}")
+
+    results = []
+    for (timestamp, image_bytes), caption, image_input in zip(frames, captions, image_inputs):
+        if caption is not None:
+            results.append((timestamp, (caption, image_input)))
+            continue
+        try:
+            results.append((timestamp, get_frame_caption(image_bytes, timestamp, model_list, custom_prompt)))
+        except Exception as err:
+            results.append((timestamp, err))
+    return results
+
+
+async def caption_frames_async(frames, model_list, stages, custom_prompt=""):
+    # Coroutine version of caption_frames; each request holds a frame-stage slot.
+    async def single(timestamp, image_bytes):
+        try:
+            async with stages.frames:
+                return timestamp, await get_frame_caption_async(image_bytes, timestamp, model_list, custom_prompt)
+        except Exception as err:
+            return timestamp, err
+
+    if len(frames) == 1:
+        return [await single(*frames[0])]
+
+    captions = [None] * len(frames)
+    image_inputs = [None] * len(frames)
+    try:
+        inputs, image_inputs = build_frame_batch_inputs(frames, custom_prompt)
+        async with stages.frames:
+            result_text = await call_gemini_async(inputs, generation_config=BATCH_GENERATION_CONFIG,
+                                                  model_list=model_list)
+        captions = parse_batch_captions(result_text, len(frames))
+    except Exception as err:
+        print(f"Batched frame request failed, captioning frames one by one: {err}")
+
+    # Results stay in input order, since callers zip them with the frames' positions
+    results = [None] * len(frames)
+    retry_slots = []
+    retries = []
+    for slot, ((timestamp, image_bytes), caption, image_input) in enumerate(zip(frames, captions, image_inputs)):
+        if caption is not None:
+            results[slot] = (timestamp, (caption, image_input))
+        else:
+            retry_slots.append(slot)
+            retries.append(single(timestamp, image_bytes))
+    for slot, result in zip(retry_slots, await asyncio.gather(*retries)):
+        results[slot] = result
+    return results
+
+
+def collect_frame_results(results, positions, source_frames):
+    # Turn (timestamp, (caption, image_input) | exception) pairs into frame data, in timestamp order.
+    # positions gives each result's index in the sampled frame sequence (kept internally as
+    # frame_index for duplicate lookups), and source_frames maps a position to its frame number
+    # in the source video.
+    frames_data = []
+    for (ts, result), position in zip(results, positions):
+        if isinstance(result, Exception):
+            print(f"Failed to caption frame at timestamp {ts}s: {result}")
+            continue
+        caption, image_input = result
+        frames_data.append({
+            "timestamp": ts,
+            "source_frame": source_frames[position],
+            "frame_index": position,
+            "caption": caption,
+            "image_input": image_input
+        })
+        print(f"Caption for timestamp {ts}s:\n{caption}\n")
+    frames_data.sort(key=lambda x: (x["timestamp"], x["source_frame"]))
+    return frames_data
+
+
+# How frames are shown to the composite model: "full" re-sends every frame as captioned,
+# "captions" sends text only, "thumbnails" sends each frame downscaled and "contact_sheet"
+# tiles all frames into one labeled image. The image modes fit their images within a byte
+# budget; "captions" fits the caption text within it instead.
+COMPOSITE_MODES = ["full", "captions", "thumbnails", "contact_sheet"]
+DEFAULT_COMPOSITE_BUDGET = 256 * 1024
+THUMBNAIL_MAX_SIDE = 512
+CONTACT_SHEET_TILE_WIDTH = 320
+
+
+def decode_image_input(image_input):
+    return cv2.imdecode(np.frombuffer(base64.b64decode(image_input["data"]), np.uint8), cv2.IMREAD_COLOR)
+
+
+def encode_within_budget(image, max_bytes, max_side=None):
+    # Encode as JPEG, lowering the quality and then the size until it fits in max_bytes.
+    height, width = image.shape[:2]
+    scale = min(1.0, max_side / max(height, width)) if max_side else 1.0
+    while True:
+        if scale < 1.0:
+            size = (max(1, int(width * scale)), max(1, int(height * scale)))
+            resized = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        else:
+            resized = image
+        for quality in (85, 70, 50):
+            success, buffer = cv2.imencode('.jpg', resized, [cv2.IMWRITE_JPEG_QUALITY, quality])
+            if not success:
+                raise ValueError("Failed to encode image")
+            if len(buffer) <= max_bytes or max(resized.shape[:2]) <= 64:
+                return buffer.tobytes()
+        scale *= 0.75
+
+
+def build_contact_sheet(frame_data_list, max_bytes, tile_width=CONTACT_SHEET_TILE_WIDTH):
+    # Tile the frames row by row into one image, each tile labeled with its frame number.
+    tiles = []
+    for number, frame_data in enumerate(frame_data_list, 1):
+        image = decode_image_input(frame_data["image_input"])
+        if image is not None:
+            tiles.append((str(number), image))
+    if not tiles:
+        return None
+    height, width = tiles[0][1].shape[:2]
+    tile_height = max(1, round(tile_width * height / width))
+    cols = math.ceil(math.sqrt(len(tiles)))
+    rows = math.ceil(len(tiles) / cols)
+    sheet = np.zeros((rows * tile_height, cols * tile_width, 3), np.uint8)
+    for k, (label, image) in enumerate(tiles):
+        row, col = divmod(k, cols)
+        tile = cv2.resize(image, (tile_width, tile_height), interpolation=cv2.INTER_AREA)
+        cv2.putText(tile, label, (8, 32), cv2.FONT_HERSHEY_SIMPLEX, 1.0, (0, 0, 0), 5, cv2.LINE_AA)
+        cv2.putText(tile, label, (8, 32), cv2.FONT_HERSHEY_SIMPLEX, 1.0, (255, 255, 255), 2, cv2.LINE_AA)
+        sheet[row * tile_height:(row + 1) * tile_height, col * tile_width:(col + 1) * tile_width] = tile
+    return encode_within_budget(sheet, max_bytes)
+
+
+def fit_captions(captions, max_bytes):
+    # Trim captions so their UTF-8 text totals at most max_bytes. Short captions are kept
+    # whole and the bytes they leave over go to the longer ones, which are cut at a word.
+    limits = {}
+    remaining = max_bytes
+    order = sorted(range(len(captions)), key=lambda i: len(captions[i].encode("utf-8")))
+    for k, i in enumerate(order):
+        limits[i] = remaining // (len(order) - k)
+        remaining -= min(limits[i], len(captions[i].encode("utf-8")))
+    fitted = []
+    for i, caption in enumerate(captions):
+        encoded = caption.encode("utf-8")
+        if len(encoded) > limits[i]:
+            cut = encoded[:max(0, limits[i] - 3)].decode("utf-8", "ignore")
+            caption = (cut.rsplit(" ", 1)[0] if " " in cut else cut) + "..."
+        fitted.append(caption)
+    return fitted
+
+
+# What the composite prompt says it was given, per mode
+COMPOSITE_SOURCES = {
+    "full": "images, timestamps, and detailed captions",
+    "captions": "timestamps and detailed captions",
+    "thumbnails": "thumbnail images, timestamps, and detailed captions",
+    "contact_sheet": "a contact sheet of the frames, timestamps, and detailed captions",
+}
+
+
+def payload_bytes(inputs):
+    return sum(len(part["data"]) if isinstance(part, dict) else len(part.encode("utf-8")) for part in inputs)
+
+
+def build_composite_inputs(frame_data_list, custom_prompt="", mode="full", budget_bytes=DEFAULT_COMPOSITE_BUDGET):
     # Build the composite input list from each frame.
     inputs = []
-    for frame_data in frame_data_list:
+    if mode == "contact_sheet":
+        sheet = build_contact_sheet(frame_data_list, budget_bytes)
+        if sheet is not None:
+            inputs.append("Contact sheet of the frames listed below, in order; each tile is labeled with its "
+                          "frame number:")
+            inputs.append(make_image_input(sheet, "image/jpeg"))
+    frame_budget = budget_bytes // max(1, len(frame_data_list))
+    captions = [frame_data["caption"] for frame_data in frame_data_list]
+    if mode == "captions":
+        captions = fit_captions(captions, budget_bytes)
+    for number, (frame_data, caption_str) in enumerate(zip(frame_data_list, captions), 1):
         ts = frame_data["timestamp"]
-        inputs.append(f"Frame at {ts}s:")
-        inputs.append(frame_data["image_input"])
-        caption_str = frame_data["caption"]
+        if mode == "contact_sheet":
+            inputs.append(f"Frame {number} at {ts}s:")
+        else:
+            inputs.append(f"Frame at {ts}s:")
+        if mode == "full":
+            inputs.append(frame_data["image_input"])
+        elif mode == "thumbnails":
+            image = decode_image_input(frame_data["image_input"])
+            if image is not None:
+                thumbnail = encode_within_budget(image, frame_budget, THUMBNAIL_MAX_SIDE)
+                inputs.append(make_image_input(thumbnail, "image/jpeg"))
         inputs.append("Caption: " + caption_str)
     composite_prompt = """
-    Using the provided data from each frame (including images, timestamps, and detailed captions), generate a single composite caption that captures everything happening throughout the video in plain language. Incorporate all details (poses, attire, nudity, actions), but if the same point is repeated across frames, merge it into one mention rather than repeating it verbatim.
+    Using the provided data from each frame (including {sources}), generate a single composite caption that captures everything happening throughout the video in plain language. Incorporate all details (poses, attire, nudity, actions), but if the same point is repeated across frames, merge it into one mention rather than repeating it verbatim.
 
     Instructions:  
     • Do not leave out any unique detail from the individual captions.  
@@ -150,17 +594,35 @@ def get_composite_caption(frame_data_list, composite_model_list, custom_prompt="
     • Always use simple, everyday language (e.g., 'pulling down panties,' 'vagina,' 'breasts,' 'butt').  
     • Keep the flow as if an average person is describing the progression of events.  
     • At the end, your composite caption should sound like a natural, single-paragraph narrative describing the entire sequence of events and actions across the video.  
-    """
+    """.format(sources=COMPOSITE_SOURCES[mode])
     # Append extra custom instructions if provided.
     if custom_prompt:
         composite_prompt += "\nAdditional instructions: " + custom_prompt.strip() + "\n"
     inputs.append(composite_prompt)
+    return inputs
+
+
+def get_composite_caption(frame_data_list, composite_model_list, custom_prompt="", mode="full",
+                          budget_bytes=DEFAULT_COMPOSITE_BUDGET):
+    inputs = build_composite_inputs(frame_data_list, custom_prompt, mode, budget_bytes)
+    print(f"Composite request ({mode}): {payload_bytes(inputs) / 1024:.0f} KB")
     composite_caption = call_gemini(inputs, generation_config=None, model_list=composite_model_list)
     return composite_caption
 
 
-def process_video(file_path, fps, individual_model_list, composite_model_list, custom_prompt="", max_frames=None,
-                  output_dir=None):
+async def get_composite_caption_async(frame_data_list, composite_model_list, custom_prompt="", mode="full",
+                                      budget_bytes=DEFAULT_COMPOSITE_BUDGET):
+    # Thumbnails and contact sheets decode and re-encode every frame, so they are built off the event loop.
+    # A thread is enough (cv2 releases the GIL) and avoids copying every frame's base64 into a worker process.
+    loop = asyncio.get_running_loop()
+    inputs = await loop.run_in_executor(None, build_composite_inputs, frame_data_list, custom_prompt, mode,
+                                        budget_bytes)
+    print(f"Composite request ({mode}): {payload_bytes(inputs) / 1024:.0f} KB")
+    return await call_gemini_async(inputs, generation_config=None, model_list=composite_model_list)
+
+
+def captions_complete(file_path):
+    # True when both the .json and .txt outputs exist and hold a composite caption.
     base_name = os.path.splitext(file_path)[0]
     output_json_filename = base_name + ".json"
     output_txt_filename = base_name + ".txt"
@@ -173,84 +635,334 @@ def process_video(file_path, fps, individual_model_list, composite_model_list, c
                 composite_text = f.read().strip()
             composite_caption_text = data.get("composite_caption", "").strip() if isinstance(data, dict) else ""
             if composite_caption_text and composite_text:
-                print(f"Skipping video file {file_path} because composite captions already exist.")
-                return
+                return True
         except Exception as e:
             print(f"Error reading existing caption files for {file_path}: {e}")
+    return False
 
-    print(f"Processing video file: {file_path}")
+
+# Gaps (in frames) above this are crossed with a container seek; shorter gaps are
+# stepped through with grab(). grab() still decodes every frame it passes and only
+# skips the colour conversion and copy of read(), so at typical sampling rates
+# (--fps 1 on a 30 fps source) every frame is decoded and only the conversions are
+# saved. A seek lands on the preceding keyframe and decodes forward from there, so
+# it only pays off for gaps longer than the keyframe interval, which OpenCV does
+# not report; 48 frames is a common GOP length (about 2 s at 24 fps).
+SEEK_MIN_GAP = 48
+
+
+def open_video(file_path):
     cap = cv2.VideoCapture(file_path)
     video_fps = cap.get(cv2.CAP_PROP_FPS)
     if video_fps == 0:
         video_fps = 25  # fallback if not provided
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    return cap, video_fps, frame_count
 
+
+def sample_indices(video_fps, frame_count, fps, max_frames=None):
+    # Frame indices sampled at `fps`, capped at max_frames.
     frame_interval = max(1, round(video_fps / fps))
-    count = 0
-    # We'll accumulate (timestamp, future) pairs in this list.
-    future_results = []
-    # Create a ThreadPoolExecutor for parallel frame captioning.
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        while True:
-            ret, frame = cap.read()
-            if not ret:
+    if frame_count > 0:
+        targets = range(0, frame_count, frame_interval)
+    else:
+        targets = itertools.count(0, frame_interval)  # unknown length: sample until the stream ends
+    if max_frames is not None:
+        targets = itertools.islice(targets, max_frames)
+    return targets
+
+
+def iter_frames_at(cap, frame_indices):
+    # Yield (frame_index, frame) for each of the ascending frame_indices, decoding
+    # only those frames: short gaps are skipped with grab(), long ones with a seek.
+    position = 0  # index of the next frame grab() would return
+    for target in frame_indices:
+        gap = target - position
+        if gap > SEEK_MIN_GAP:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, target)
+        else:
+            for _ in range(gap):
+                if not cap.grab():
+                    return
+        if not cap.grab():
+            return
+        position = target + 1
+        ret, frame = cap.retrieve()
+        if ret:
+            yield target, frame
+
+
+def iter_sampled_frames(file_path, fps, max_frames=None, encoder=None):
+    # Yield (timestamp, image_bytes, source_frame) for each frame sampled at `fps`. The target
+    # frame indices are computed up front so only the frames that are sent get
+    # fully decoded.
+    encoder = encoder or payload_encoder
+    cap, video_fps, frame_count = open_video(file_path)
+    sampled = 0
+    try:
+        for index, frame in iter_frames_at(cap, sample_indices(video_fps, frame_count, fps, max_frames)):
+            timestamp = int(index / video_fps)
+            try:
+                image_bytes = encoder.encode(frame)
+            except ValueError:
+                print(f"Failed to encode frame at timestamp {timestamp}.")
+                continue
+            yield timestamp, image_bytes, index
+            sampled += 1
+        if max_frames is not None and sampled >= max_frames:
+            print(f"Reached maximum number of frames ({max_frames}). Stopping frame sampling.")
+    finally:
+        cap.release()
+
+
+def frame_hash(frame):
+    # 64-bit difference hash: compares neighbouring pixels of a 9x8 greyscale thumbnail.
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return sum(1 << i for i, bit in enumerate(bits) if bit)
+
+
+def select_keyframes(hashes, min_frames=1, max_frames=None, threshold=10):
+    # Pick candidate positions whose hash differs from the last picked one by more
+    # than `threshold` bits. Over budget, keep the first frame plus the biggest
+    # changes; under min_frames, top up with evenly spaced candidates.
+    selected = [0]
+    scores = {}
+    anchor = hashes[0]
+    for i, h in enumerate(hashes[1:], 1):
+        distance = bin(h ^ anchor).count("1")
+        if distance > threshold:
+            selected.append(i)
+            scores[i] = distance
+            anchor = h
+    if max_frames is not None and len(selected) > max_frames:
+        strongest = sorted(selected[1:], key=lambda i: scores[i], reverse=True)[:max(0, max_frames - 1)]
+        selected = [0] + sorted(strongest)
+    target = min(min_frames, len(hashes))
+    if len(selected) < target:
+        spread = [round(k * (len(hashes) - 1) / (target - 1)) for k in range(target)] if target > 1 else [0]
+        chosen = set(selected)
+        for i in spread:
+            if len(chosen) >= target:
+                break
+            chosen.add(i)
+        for i in range(len(hashes)):
+            if len(chosen) >= target:
                 break
-            if count % frame_interval == 0:
-                timestamp = int(count / video_fps)
-                success, buffer = cv2.imencode('.jpg', frame)
-                if not success:
-                    print(f"Failed to encode frame at timestamp {timestamp}.")
-                    count += 1
-                    continue
-                image_bytes = buffer.tobytes()
-                # Submit the get_frame_caption call to the executor with the custom prompt.
-                future = executor.submit(get_frame_caption, image_bytes, timestamp, individual_model_list,
-                                         custom_prompt)
-                future_results.append((timestamp, future))
-                # Optionally, limit the total number of frames processed:
-                if max_frames is not None and len(future_results) >= max_frames:
-                    print(f"Reached maximum number of frames ({max_frames}). Stopping frame sampling.")
-                    break
-            count += 1
-    cap.release()
+            chosen.add(i)
+        selected = sorted(chosen)
+    return selected
 
-    # Gather results, ensuring we keep the timestamp order.
-    frames_data = []
-    for ts, future in future_results:
-        try:
-            caption, image_input = future.result()
-            frames_data.append({
-                "timestamp": ts,
-                "caption": caption,
-                "image_input": image_input
-            })
-            print(f"Caption for timestamp {ts}s:\n{caption}\n")
-        except Exception as err:
-            print(f"Failed to caption frame at timestamp {ts}s: {err}")
 
-    # Ensure the order is correct.
-    frames_data.sort(key=lambda x: x["timestamp"])
+def select_frames_by_change(file_path, fps, min_frames=1, max_frames=None, threshold=10, encoder=None):
+    """
+    Adaptive sampling: hash every candidate frame at `fps`, keep only frames that
+    differ visibly from the previous kept one (within min/max_frames), and decode
+    and encode just those.
 
-    # Now that all individual frame captioning is complete, get the composite caption.
+    Returns (sampled, duplicates): sampled is a list of (timestamp, image_bytes, source_frame).
+    duplicates lists every candidate that was not kept as (timestamp, source_frame, kept_position):
+    kept_position is the index in sampled of the kept frame it matches, or None
+    if the frame differs visibly from it (e.g. it was only dropped to fit max_frames).
+    """
+    encoder = encoder or payload_encoder
+    cap, video_fps, frame_count = open_video(file_path)
+    candidates = []
+    hashes = []
     try:
-        composite = get_composite_caption(frames_data, composite_model_list, custom_prompt)
-        print("Composite caption for video:")
-        print(composite)
-    except Exception as e:
-        print(f"Failed to get composite caption: {e}")
-        composite = ""
+        for index, frame in iter_frames_at(cap, sample_indices(video_fps, frame_count, fps)):
+            candidates.append(index)
+            hashes.append(frame_hash(frame))
+    finally:
+        cap.release()
+    if not candidates:
+        return [], []
 
-    if composite.strip():
+    selected = select_keyframes(hashes, min_frames, max_frames, threshold)
+    sampled = []
+    # candidate -> position in sampled, for selected frames that encoded
+    sampled_positions = {}
+    cap, video_fps, _ = open_video(file_path)
+    try:
+        for i, (index, frame) in zip(selected, iter_frames_at(cap, [candidates[i] for i in selected])):
+            timestamp = int(index / video_fps)
+            try:
+                sampled.append((timestamp, encoder.encode(frame), index))
+                sampled_positions[i] = len(sampled) - 1
+            except ValueError:
+                print(f"Failed to encode frame at timestamp {timestamp}.")
+    finally:
+        cap.release()
+
+    # A skipped frame borrows the caption of the last kept frame before it only if it
+    # is actually within the threshold of that frame; frames dropped by max_frames aren't.
+    selected_set = set(selected)
+    duplicates = []
+    kept = selected[0]
+    for i, index in enumerate(candidates):
+        if i in selected_set:
+            kept = i
+            continue
+        kept_position = sampled_positions.get(kept)
+        if kept_position is not None and bin(hashes[i] ^ hashes[kept]).count("1") > threshold:
+            kept_position = None
+        duplicates.append((int(index / video_fps), index, kept_position))
+    print(f"Selected {len(sampled)} of {len(candidates)} candidate frames by visual change.")
+    return sampled, duplicates
+
+
+def sample_video_frames(file_path, fps, max_frames=None, sampling="uniform", min_frames=1, change_threshold=10,
+                        encoder=None):
+    # Returns (sampled, duplicates, encoder stats) as plain values, so it can run in a worker process.
+    # The copy starts with empty stats, so the caller can merge them without counting twice.
+    encoder = copy.copy(encoder or payload_encoder)
+    if sampling == "adaptive":
+        sampled, duplicates = select_frames_by_change(file_path, fps, min_frames, max_frames, change_threshold,
+                                                      encoder)
+    else:
+        sampled, duplicates = list(iter_sampled_frames(file_path, fps, max_frames, encoder)), []
+    return sampled, duplicates, encoder.stats
+
+
+def with_duplicate_frames(frames_data, duplicates):
+    # Near-duplicate frames reuse the caption of the kept frame they were matched to,
+    # looked up by position since several frames share a timestamp when fps > 1.
+    # Frames that don't match their kept frame (mostly ones dropped to fit max_frames)
+    # are listed without a caption.
+    kept_frames = {frame_data["frame_index"]: frame_data for frame_data in frames_data}
+    all_frames = list(frames_data)
+    for ts, source_frame, kept_position in duplicates:
+        if kept_position is None:
+            all_frames.append({"timestamp": ts, "source_frame": source_frame, "caption": None, "skipped": True})
+            continue
+        kept_frame = kept_frames.get(kept_position)
+        if kept_frame is not None:
+            all_frames.append({"timestamp": ts, "source_frame": source_frame, "caption": kept_frame["caption"],
+                               "duplicate_of": kept_frame["timestamp"],
+                               "duplicate_of_frame": kept_frame["source_frame"]})
+    all_frames.sort(key=lambda x: (x["timestamp"], x.get("source_frame", 0)))
+    return all_frames
+
+
+# Frame captions are appended to <video>.frames.jsonl as they complete, so a run
+# that stops midway can resume with only the frames that are still missing.
+_checkpoint_lock = threading.Lock()
+
+
+def checkpoint_path_for(file_path):
+    return os.path.splitext(file_path)[0] + ".frames.jsonl"
+
+
+def load_frame_checkpoint(file_path, settings):
+    """
+    Return {position: {"timestamp": ..., "caption": ...}} for frames captioned by
+    an earlier run with the same settings. A checkpoint written with different
+    settings is discarded and a new one started.
+    """
+    path = checkpoint_path_for(file_path)
+    done = {}
+    if os.path.exists(path):
         try:
-            final_caption = rewrite_composite_caption(composite)
-            print("Final rewritten caption:")
-            print(final_caption)
-            composite = final_caption
+            with open(path, "r") as f:
+                header = json.loads(f.readline() or "{}")
+                if header.get("settings") == settings:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            break  # partial last line from an interrupted write
+                        done[entry["position"]] = entry
         except Exception as e:
-            print(f"Error rewriting composite caption: {e}")
+            print(f"Ignoring unreadable checkpoint {path}: {e}")
+            done = {}
+    if done:
+        print(f"Resuming {file_path}: {len(done)} frame captions restored from checkpoint.")
+    else:
+        with open(path, "w") as f:
+            f.write(json.dumps({"settings": settings}) + "\n")
+    return done
+
+
+def append_frame_checkpoint(file_path, positions, results):
+    lines = []
+    for position, (ts, result) in zip(positions, results):
+        if not isinstance(result, Exception):
+            lines.append(json.dumps({"position": position, "timestamp": ts, "caption": result[0]}) + "\n")
+    if lines:
+        with _checkpoint_lock:
+            with open(checkpoint_path_for(file_path), "a") as f:
+                f.writelines(lines)
+
+
+def caption_frames_checkpointed(file_path, positions, frames, model_list, custom_prompt=""):
+    results = caption_frames(frames, model_list, custom_prompt)
+    append_frame_checkpoint(file_path, positions, results)
+    return results
+
+
+def restore_or_queue_frames(sampled, done):
+    # Split sampled frames into restored results and frames still to caption, each with their positions.
+    restored_positions = []
+    restored = []
+    positions = []
+    pending = []
+    for position, (timestamp, image_bytes, _) in enumerate(sampled):
+        entry = done.get(position)
+        if entry is not None and entry["timestamp"] == timestamp:
+            restored_positions.append(position)
+            restored.append((timestamp, (entry["caption"], make_image_input(image_bytes))))
+        else:
+            positions.append(position)
+            pending.append((timestamp, image_bytes))
+    return restored_positions, restored, positions, pending
+
+
+def thumbnail_dir_for(file_path):
+    return os.path.splitext(file_path)[0] + ".frames"
+
+
+def frame_reference(frame_data, file_path, thumbnail_size=0):
+    """
+    Replace a frame's inline image with a reference for the caption JSON: its
+    source_frame number in the video, the sha256 of the JPEG that was sent and,
+    if thumbnail_size is set, the path of a small JPEG copy (relative to the JSON
+    file). The base64 image is only needed in memory for the composite request
+    and would otherwise make up almost all of the file.
+    """
+    # frame_index is the position among the sampled frames, only meaningful within this run
+    reference = {key: value for key, value in frame_data.items() if key not in ("image_input", "frame_index")}
+    image_input = frame_data.get("image_input")
+    if image_input is None:
+        return reference
+    image_bytes = base64.b64decode(image_input["data"])
+    reference["sha256"] = hashlib.sha256(image_bytes).hexdigest()
+    if thumbnail_size:
+        image = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+        if image is not None:
+            height, width = image.shape[:2]
+            scale = min(1.0, thumbnail_size / max(height, width))
+            if scale < 1.0:
+                image = cv2.resize(image, (max(1, round(width * scale)), max(1, round(height * scale))),
+                                   interpolation=cv2.INTER_AREA)
+            thumbnail_dir = thumbnail_dir_for(file_path)
+            os.makedirs(thumbnail_dir, exist_ok=True)
+            name = f"frame_{frame_data.get('source_frame', 0):06d}.jpg"
+            cv2.imwrite(os.path.join(thumbnail_dir, name), image)
+            reference["thumbnail"] = os.path.basename(thumbnail_dir) + "/" + name
+    return reference
+
+
+def save_captions(file_path, frames_data, composite, output_dir=None, thumbnail_size=0):
+    base_name = os.path.splitext(file_path)[0]
+    output_json_filename = base_name + ".json"
+    output_txt_filename = base_name + ".txt"
+    thumbnail_dir = thumbnail_dir_for(file_path)
 
     # Save the individual captions (JSON) including the composite caption and the plain text separately.
+    frames = [frame_reference(frame_data, file_path, thumbnail_size) for frame_data in frames_data]
     with open(output_json_filename, "w") as f:
-        json.dump({"frames": frames_data, "composite_caption": composite}, f, indent=2)
+        json.dump({"frames": frames, "composite_caption": composite}, f, indent=2)
     print(f"Captions saved to {output_json_filename}")
 
     # Write only the composite caption text to the final txt file.
@@ -264,16 +976,94 @@ def process_video(file_path, fps, individual_model_list, composite_model_list, c
             shutil.move(file_path, os.path.join(output_dir, os.path.basename(file_path)))
             shutil.move(output_json_filename, os.path.join(output_dir, os.path.basename(output_json_filename)))
             shutil.move(output_txt_filename, os.path.join(output_dir, os.path.basename(output_txt_filename)))
-            print(f"Moved video file and captions to {output_dir}")
+            if os.path.isdir(thumbnail_dir):
+                target_dir = os.path.join(output_dir, os.path.basename(thumbnail_dir))
+                shutil.rmtree(target_dir, ignore_errors=True)
+                shutil.move(thumbnail_dir, target_dir)
+            print(f"Moved source file and captions to {output_dir}")
         except Exception as e:
             print(f"Error moving files to {output_dir}: {e}")
 
 
-def process_image(file_path, individual_model_list, composite_model_list, custom_prompt="", output_dir=None):
+def process_video(file_path, fps, individual_model_list, composite_model_list, custom_prompt="", max_frames=None,
+                  output_dir=None, sampling="uniform", min_frames=1, change_threshold=10, frame_batch_size=1,
+                  thumbnail_size=0, composite_mode="full", composite_budget=DEFAULT_COMPOSITE_BUDGET):
+    if captions_complete(file_path):
+        print(f"Skipping video file {file_path} because composite captions already exist.")
+        return
+
+    print(f"Processing video file: {file_path}")
+    settings = {"fps": fps, "max_frames": max_frames, "sampling": sampling, "min_frames": min_frames,
+                "change_threshold": change_threshold, "custom_prompt": custom_prompt}
+    done = load_frame_checkpoint(file_path, settings)
+    # Restored frames are collected directly; the rest go out in batches of frame_batch_size.
+    results = []
+    result_positions = []
+    source_frames = []
+    futures = []
+    if sampling == "adaptive":
+        sampled, duplicates = select_frames_by_change(file_path, fps, min_frames, max_frames, change_threshold)
+    else:
+        # Uniform frames are streamed so captioning starts while the video is still being read.
+        sampled, duplicates = iter_sampled_frames(file_path, fps, max_frames), []
+    # Create a ThreadPoolExecutor for parallel frame captioning.
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        positions = []
+        batch = []
+        for position, (timestamp, image_bytes, source_frame) in enumerate(sampled):
+            source_frames.append(source_frame)
+            entry = done.get(position)
+            if entry is not None and entry["timestamp"] == timestamp:
+                results.append((timestamp, (entry["caption"], make_image_input(image_bytes))))
+                result_positions.append(position)
+                continue
+            positions.append(position)
+            batch.append((timestamp, image_bytes))
+            if len(batch) >= frame_batch_size:
+                futures.append((executor.submit(caption_frames_checkpointed, file_path, positions, batch,
+                                                individual_model_list, custom_prompt), positions))
+                positions = []
+                batch = []
+        if batch:
+            futures.append((executor.submit(caption_frames_checkpointed, file_path, positions, batch,
+                                            individual_model_list, custom_prompt), positions))
+
+    # Gather results, ensuring we keep the timestamp order.
+    for future, batch_positions in futures:
+        results.extend(future.result())
+        result_positions.extend(batch_positions)
+    frames_data = collect_frame_results(results, result_positions, source_frames)
+
+    # Now that all individual frame captioning is complete, get the composite caption.
+    try:
+        composite = get_composite_caption(frames_data, composite_model_list, custom_prompt,
+                                          composite_mode, composite_budget)
+        print("Composite caption for video:")
+        print(composite)
+    except Exception as e:
+        print(f"Failed to get composite caption: {e}")
+        composite = ""
+
+    if composite.strip():
+        try:
+            final_caption = rewrite_composite_caption(composite)
+            print("Final rewritten caption:")
+            print(final_caption)
+            composite = final_caption
+        except Exception as e:
+            print(f"Error rewriting composite caption: {e}")
+
+    save_captions(file_path, with_duplicate_frames(frames_data, duplicates), composite, output_dir, thumbnail_size)
+    if composite.strip():
+        os.remove(checkpoint_path_for(file_path))
+
+
+def process_image(file_path, individual_model_list, composite_model_list, custom_prompt="", output_dir=None,
+                  thumbnail_size=0, composite_mode="full", composite_budget=DEFAULT_COMPOSITE_BUDGET):
     print(f"Processing image file: {file_path}")
     try:
         with open(file_path, "rb") as f:
-            image_bytes = f.read()
+            image_bytes = payload_encoder.encode_file_bytes(f.read())
 
         # Get the caption for the image
         caption, image_input = get_frame_caption(image_bytes, 0, individual_model_list, custom_prompt)
@@ -282,13 +1072,16 @@ def process_image(file_path, individual_model_list, composite_model_list, custom
         # Create a frame_data structure as done for videos (even though there is only one frame)
         frame_data = {
             "timestamp": 0,
+            "source_frame": 0,
+            "frame_index": 0,
             "caption": caption,
             "image_input": image_input
         }
         frames_data = [frame_data]
 
         # Get the composite caption based on a single frame
-        composite = get_composite_caption(frames_data, composite_model_list, custom_prompt)
+        composite = get_composite_caption(frames_data, composite_model_list, custom_prompt,
+                                          composite_mode, composite_budget)
         print("Composite caption for image:")
         print(composite)
 
@@ -302,28 +1095,116 @@ def process_image(file_path, individual_model_list, composite_model_list, custom
             except Exception as e:
                 print(f"Error rewriting composite caption: {e}")
 
-        # Save the JSON structure and plain text caption
-        base_name = os.path.splitext(file_path)[0]
-        output_json_filename = base_name + ".json"
-        output_txt_filename = base_name + ".txt"
+        save_captions(file_path, frames_data, composite, output_dir, thumbnail_size)
 
-        json_data = {"frames": frames_data, "composite_caption": composite}
-        with open(output_json_filename, "w") as out_f:
-            json.dump(json_data, out_f, indent=2)
-        print(f"Caption JSON saved to {output_json_filename}")
+    except Exception as e:
+        print(f"Error processing image {file_path}: {e}")
 
-        with open(output_txt_filename, "w") as out_f:
-            out_f.write(composite)
-        print(f"Caption text saved to {output_txt_filename}")
 
-        # Optionally, move outputs to the output directory.
-        if output_dir:
-            os.makedirs(output_dir, exist_ok=True)
-            import shutil
-            shutil.move(file_path, os.path.join(output_dir, os.path.basename(file_path)))
-            shutil.move(output_json_filename, os.path.join(output_dir, os.path.basename(output_json_filename)))
-            shutil.move(output_txt_filename, os.path.join(output_dir, os.path.basename(output_txt_filename)))
-            print(f"Moved image file and captions to {output_dir}")
+async def process_video_async(file_path, fps, individual_model_list, composite_model_list, stages,
+                              custom_prompt="", max_frames=None, output_dir=None, sampling="uniform",
+                              min_frames=1, change_threshold=10, frame_batch_size=1, thumbnail_size=0,
+                              composite_mode="full", composite_budget=DEFAULT_COMPOSITE_BUDGET):
+    # Output and checkpoint files are read and written on the default thread pool, so slow
+    # disks don't stall requests in flight.
+    loop = asyncio.get_running_loop()
+    if await loop.run_in_executor(None, captions_complete, file_path):
+        print(f"Skipping video file {file_path} because composite captions already exist.")
+        return
+
+    print(f"Processing video file: {file_path}")
+    settings = {"fps": fps, "max_frames": max_frames, "sampling": sampling, "min_frames": min_frames,
+                "change_threshold": change_threshold, "custom_prompt": custom_prompt}
+    done = await loop.run_in_executor(None, load_frame_checkpoint, file_path, settings)
+    # Decoding is CPU-bound, so it runs in the process pool rather than on the event loop.
+    sampled, duplicates, encoder_stats = await loop.run_in_executor(
+        stages.decode_pool, sample_video_frames, file_path, fps, max_frames, sampling, min_frames, change_threshold,
+        payload_encoder
+    )
+    payload_encoder.merge(encoder_stats)
+    restored_positions, restored, positions, pending = restore_or_queue_frames(sampled, done)
+
+    async def caption_batch(batch_positions, batch):
+        results = await caption_frames_async(batch, individual_model_list, stages, custom_prompt)
+        await loop.run_in_executor(None, append_frame_checkpoint, file_path, batch_positions, results)
+        return results
+
+    batch_results = await asyncio.gather(*(
+        caption_batch(positions[i:i + frame_batch_size], pending[i:i + frame_batch_size])
+        for i in range(0, len(pending), frame_batch_size)
+    ))
+    source_frames = [source_frame for _, _, source_frame in sampled]
+    frames_data = collect_frame_results(restored + [result for results in batch_results for result in results],
+                                        restored_positions + positions, source_frames)
+
+    try:
+        async with stages.composites:
+            composite = await get_composite_caption_async(frames_data, composite_model_list, custom_prompt,
+                                                          composite_mode, composite_budget)
+        print("Composite caption for video:")
+        print(composite)
+    except Exception as e:
+        print(f"Failed to get composite caption: {e}")
+        composite = ""
+
+    if composite.strip():
+        try:
+            async with stages.rewrites:
+                final_caption = await rewrite_composite_caption_async(composite)
+            print("Final rewritten caption:")
+            print(final_caption)
+            composite = final_caption
+        except Exception as e:
+            print(f"Error rewriting composite caption: {e}")
+
+    # Hashing frames and writing thumbnails is CPU work too; keep it off the event loop.
+    await loop.run_in_executor(None, save_captions, file_path, with_duplicate_frames(frames_data, duplicates),
+                               composite, output_dir, thumbnail_size)
+    if composite.strip():
+        await loop.run_in_executor(None, os.remove, checkpoint_path_for(file_path))
+
+
+async def process_image_async(file_path, individual_model_list, composite_model_list, stages,
+                              custom_prompt="", output_dir=None, thumbnail_size=0, composite_mode="full",
+                              composite_budget=DEFAULT_COMPOSITE_BUDGET):
+    print(f"Processing image file: {file_path}")
+    loop = asyncio.get_running_loop()
+    try:
+        with open(file_path, "rb") as f:
+            data = f.read()
+        # Decoding and re-encoding a full-size image would stall every request in flight.
+        image_bytes = await loop.run_in_executor(None, payload_encoder.encode_file_bytes, data)
+
+        async with stages.frames:
+            caption, image_input = await get_frame_caption_async(image_bytes, 0, individual_model_list,
+                                                                 custom_prompt)
+        print(f"Initial caption for image {file_path}:\n{caption}\n")
+        frames_data = [{
+            "timestamp": 0,
+            "source_frame": 0,
+            "frame_index": 0,
+            "caption": caption,
+            "image_input": image_input
+        }]
+
+        async with stages.composites:
+            composite = await get_composite_caption_async(frames_data, composite_model_list, custom_prompt,
+                                                          composite_mode, composite_budget)
+        print("Composite caption for image:")
+        print(composite)
+
+        if composite.strip():
+            try:
+                async with stages.rewrites:
+                    final_caption = await rewrite_composite_caption_async(composite)
+                print("Final rewritten caption:")
+                print(final_caption)
+                composite = final_caption
+            except Exception as e:
+                print(f"Error rewriting composite caption: {e}")
+
+        await loop.run_in_executor(None, save_captions, file_path, frames_data, composite, output_dir,
+                                   thumbnail_size)
 
     except Exception as e:
         print(f"Error processing image {file_path}: {e}")
@@ -334,15 +1215,66 @@ def process_file(file_path, args, video_exts, image_exts):
     if ext in video_exts:
         process_video(file_path, args.fps, INDIVIDUAL_FALLBACK_MODELS,
                       COMPOSITE_FALLBACK_MODELS, custom_prompt=args.custom_prompt,
-                      max_frames=args.max_frames, output_dir=args.output_dir)
+                      max_frames=args.max_frames, output_dir=args.output_dir, sampling=args.sampling,
+                      min_frames=args.min_frames, change_threshold=args.change_threshold,
+                      frame_batch_size=args.frame_batch_size, thumbnail_size=args.thumbnail_size,
+                      composite_mode=args.composite_mode, composite_budget=args.composite_budget_kb * 1024)
     elif ext in image_exts:
         process_image(file_path, INDIVIDUAL_FALLBACK_MODELS, COMPOSITE_FALLBACK_MODELS,
-                      custom_prompt=args.custom_prompt, output_dir=args.output_dir)
+                      custom_prompt=args.custom_prompt, output_dir=args.output_dir,
+                      thumbnail_size=args.thumbnail_size, composite_mode=args.composite_mode,
+                      composite_budget=args.composite_budget_kb * 1024)
     else:
         print(f"Skipping unsupported file type: {file_path}")
 
 
+async def process_file_async(file_path, args, video_exts, image_exts, stages):
+    ext = os.path.splitext(file_path)[1].lower()
+    async with stages.files:
+        if ext in video_exts:
+            await process_video_async(file_path, args.fps, INDIVIDUAL_FALLBACK_MODELS,
+                                      COMPOSITE_FALLBACK_MODELS, stages, custom_prompt=args.custom_prompt,
+                                      max_frames=args.max_frames, output_dir=args.output_dir,
+                                      sampling=args.sampling, min_frames=args.min_frames,
+                                      change_threshold=args.change_threshold,
+                                      frame_batch_size=args.frame_batch_size,
+                                      thumbnail_size=args.thumbnail_size, composite_mode=args.composite_mode,
+                                      composite_budget=args.composite_budget_kb * 1024)
+        elif ext in image_exts:
+            await process_image_async(file_path, INDIVIDUAL_FALLBACK_MODELS, COMPOSITE_FALLBACK_MODELS, stages,
+                                      custom_prompt=args.custom_prompt, output_dir=args.output_dir,
+                                      thumbnail_size=args.thumbnail_size, composite_mode=args.composite_mode,
+                                      composite_budget=args.composite_budget_kb * 1024)
+        else:
+            print(f"Skipping unsupported file type: {file_path}")
+
+
+async def run_async_engine(file_paths, args, video_exts, image_exts):
+    # One event loop drives every request. Bounded semaphores cap how much work each
+    # stage may have in flight, which keeps memory predictable; the rate limiter
+    # still decides how many requests actually go out per model.
+    # Workers are spawned rather than forked: by now the stats reporter thread and gRPC
+    # channels may be live, and forking a process holding those can hang the child.
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.decode_workers,
+                                                mp_context=multiprocessing.get_context("spawn")) as decode_pool:
+        stages = types.SimpleNamespace(
+            files=asyncio.BoundedSemaphore(args.max_files_in_flight),
+            frames=asyncio.BoundedSemaphore(args.frame_concurrency),
+            composites=asyncio.BoundedSemaphore(args.composite_concurrency),
+            rewrites=asyncio.BoundedSemaphore(args.rewrite_concurrency),
+            decode_pool=decode_pool,
+        )
+        results = await asyncio.gather(
+            *(process_file_async(fp, args, video_exts, image_exts, stages) for fp in file_paths),
+            return_exceptions=True
+        )
+    for result in results:
+        if isinstance(result, Exception):
+            print(f"Error processing a file: {result}")
+
+
 def main():
+    global caption_cache, payload_encoder
     parser = argparse.ArgumentParser(
         description="Caption all videos/images in a directory using the Gemini API with fallback. "
                     "Uses lower-tier models for individual frames and a top-quality model for the final composite caption. "
@@ -352,19 +1284,96 @@ def main():
     parser.add_argument("--fps", type=float, default=1.0, help="Frames per second to sample from videos (default 1)")
     parser.add_argument("--max_frames", type=int, default=None,
                         help="Maximum number of frames to caption for each video (optional)")
+    parser.add_argument("--sampling", choices=["uniform", "adaptive"], default="uniform",
+                        help="uniform: every frame at --fps (default); adaptive: only frames at --fps that "
+                             "differ visibly from the last kept frame, near-duplicates reuse its caption")
+    parser.add_argument("--min_frames", type=int, default=1,
+                        help="Adaptive sampling: minimum frames to caption per video (default 1)")
+    parser.add_argument("--change_threshold", type=int, default=10,
+                        help="Adaptive sampling: perceptual hash bits (of 64) that must differ to keep a frame "
+                             "(default 10)")
+    parser.add_argument("--frame_batch_size", type=int, default=1,
+                        help="Frames captioned per request; above 1, several timestamped frames share one request "
+                             "and the per-frame captions are parsed from a JSON answer (default 1)")
+    parser.add_argument("--thumbnail_size", type=int, default=0,
+                        help="Save a JPEG thumbnail (longest side in pixels) of each captioned frame next to the "
+                             "caption JSON and reference it there (default 0, off)")
+    parser.add_argument("--max_side", type=int, default=None,
+                        help="Downscale frames and images so their longest side fits before upload "
+                             "(default 1536, 0 keeps the source size)")
+    parser.add_argument("--image_format", choices=list(IMAGE_FORMATS), default=None,
+                        help="Upload encoding for frames and images (default jpeg)")
+    parser.add_argument("--image_quality", type=int, default=None,
+                        help="JPEG/WebP quality for uploads (default 85)")
+    parser.add_argument("--payload_stats", action="store_true",
+                        help="Also encode each frame as a full-size JPEG, the way frames were sent before, to report "
+                             "the upload bytes saved (costs one extra encode per frame)")
+    parser.add_argument("--composite_mode", choices=COMPOSITE_MODES, default="full",
+                        help="Frames sent with the composite request: full images (default), captions only, "
+                             "downscaled thumbnails or a single contact-sheet image")
+    parser.add_argument("--composite_budget_kb", type=int, default=DEFAULT_COMPOSITE_BUDGET // 1024,
+                        help="Total image size for the thumbnails and contact_sheet composite modes, or total "
+                             "caption text in captions mode (default %(default)s KB)")
     parser.add_argument("--output_dir", type=str, default=None,
                         help="Directory to move source files and captions once captioning succeeds")
     # NEW: custom prompt argument. This can be a string with extra instructions.
     parser.add_argument("--custom_prompt", type=str, default="",
                         help="Custom instructions to include in captions for both individual frames and composite caption")
+    parser.add_argument("--rpm", type=int, default=60,
+                        help="Requests per minute allowed per model across all workers (default 60, 0 for no limit)")
+    parser.add_argument("--model_rpm", action="append", default=[], metavar="MODEL=RPM",
+                        help="Per-model override of --rpm, e.g. gemini-2.0-flash=2000 (repeatable, 0 for no limit)")
+    parser.add_argument("--max_concurrency", type=int, default=32,
+                        help="Upper bound on concurrent requests per model; the limiter adapts below it (default 32)")
+    parser.add_argument("--cooldown", type=float, default=30.0,
+                        help="Seconds to skip a model after a rate-limit error; doubles on repeated hits (default 30)")
+    parser.add_argument("--stats_interval", type=float, default=30.0,
+                        help="Seconds between rate limiter stats reports (0 disables, default 30)")
+    parser.add_argument("--cache_dir", type=str, default=DEFAULT_CACHE_DIR,
+                        help=f"Directory for cached caption responses (default {DEFAULT_CACHE_DIR})")
+    parser.add_argument("--cache_max_gb", type=float, default=1.0,
+                        help="Size cap for the caption cache; least recently used entries are evicted (default 1)")
+    parser.add_argument("--no_cache", action="store_true", help="Always call the API, ignoring cached captions")
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads",
+                        help="threads: thread pool per file and per video (default); "
+                             "asyncio: single event loop with async API calls")
+    parser.add_argument("--max_files_in_flight", type=int, default=32,
+                        help="asyncio engine: files processed concurrently (default 32)")
+    parser.add_argument("--frame_concurrency", type=int, default=1000,
+                        help="asyncio engine: frame caption requests in flight (default 1000)")
+    parser.add_argument("--composite_concurrency", type=int, default=100,
+                        help="asyncio engine: composite caption requests in flight (default 100)")
+    parser.add_argument("--rewrite_concurrency", type=int, default=100,
+                        help="asyncio engine: rewrite requests in flight (default 100)")
+    parser.add_argument("--decode_workers", type=int, default=2,
+                        help="asyncio engine: processes used to decode video frames (default 2)")
     args = parser.parse_args()
 
+    model_rpm = {}
+    for item in args.model_rpm:
+        model_name, _, rpm = item.partition("=")
+        try:
+            model_rpm[model_name] = int(rpm)
+        except ValueError:
+            parser.error(f"--model_rpm expects MODEL=RPM, got {item!r}")
+    if args.rpm < 0 or any(rpm < 0 for rpm in model_rpm.values()):
+        parser.error("--rpm and --model_rpm must be 0 (no limit) or more")
+
     api_key = os.environ.get("GEMINI_API_KEY")
     if not api_key:
         print("Please set the GEMINI_API_KEY environment variable.")
         sys.exit(1)
     genai.configure(api_key=api_key)
 
+    rate_limiter.configure(rpm=args.rpm, max_concurrency=args.max_concurrency, model_rpm=model_rpm)
+    model_health.cooldown = args.cooldown
+    if not args.no_cache:
+        caption_cache = CaptionCache(args.cache_dir, int(args.cache_max_gb * 1024 ** 3))
+    payload_encoder = PayloadEncoder("gemini", args.max_side, args.image_format, args.image_quality,
+                                     measure_savings=args.payload_stats)
+    if args.stats_interval > 0:
+        rate_limiter.start_reporter(args.stats_interval)
+
     directory = args.dir
     video_exts = {".mp4", ".mov", ".m4v", ".avi", ".mpeg", ".wmv", ".flv", ".mpg", ".webm", ".3gpp"}
     image_exts = {".jpg", ".jpeg", ".png", ".webp", ".heic", ".heif"}
@@ -376,15 +1385,23 @@ def main():
         if os.path.isfile(file_path):
             file_paths.append(file_path)
 
-    # Use a thread pool to process files concurrently
-    with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-        futures = [executor.submit(process_file, fp, args, video_exts, image_exts) for fp in file_paths]
-        # Optionally wait for all jobs to complete and handle exceptions
-        for future in concurrent.futures.as_completed(futures):
-            try:
-                future.result()
-            except Exception as e:
-                print(f"Error processing a file: {e}")
+    if args.engine == "asyncio":
+        asyncio.run(run_async_engine(file_paths, args, video_exts, image_exts))
+    else:
+        # Use a thread pool to process files concurrently
+        with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
+            futures = [executor.submit(process_file, fp, args, video_exts, image_exts) for fp in file_paths]
+            # Optionally wait for all jobs to complete and handle exceptions
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"Error processing a file: {e}")
+
+    print(f"Rate limiter stats:\n{rate_limiter.format_stats()}")
+    if caption_cache is not None:
+        print(caption_cache.summary())
+    print(payload_encoder.summary())
 
 
 if __name__ == "__main__":
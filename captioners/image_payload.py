@@ -0,0 +1,166 @@
+"""
+Shared image encoding for caption API uploads.
+
+Frames are usually decoded at full source resolution, but the APIs scale every
+image down before the model sees it. PayloadEncoder resizes to what a provider
+actually uses, picks the output format and quality, and keeps the base64 form
+of recent payloads so retries and fallback models reuse the same string instead
+of encoding the image again. It also counts sent bytes and, when asked to
+measure savings, what the same images would have cost the way they were sent
+before (a full-resolution JPEG for Gemini, a PNG for OpenAI), so a run can
+report how much upload it saved.
+
+Encoders can be pickled into worker processes; the copy starts with empty
+stats, which the worker hands back for merge().
+"""
+
+import base64
+import collections
+import threading
+
+import cv2
+import numpy as np
+
+# Largest useful size per provider: Gemini tiles images into 768px crops, and
+# OpenAI's high detail mode fits the image in 2048px and then the short side in 768px.
+# baseline_format is what each captioner sent before: cv2's default full-size JPEG or PNG.
+PROVIDER_PROFILES = {
+    "gemini": {"max_side": 1536, "max_short_side": None, "image_format": "jpeg", "quality": 85,
+               "baseline_format": "jpeg"},
+    "openai": {"max_side": 2048, "max_short_side": 768, "image_format": "jpeg", "quality": 85,
+               "baseline_format": "png"},
+}
+
+# format -> (file extension, mime type, quality flag)
+IMAGE_FORMATS = {
+    "jpeg": (".jpg", "image/jpeg", cv2.IMWRITE_JPEG_QUALITY),
+    "webp": (".webp", "image/webp", cv2.IMWRITE_WEBP_QUALITY),
+    "png": (".png", "image/png", None),
+}
+
+
+class PayloadEncoder:
+    def __init__(self, provider="gemini", max_side=None, image_format=None, quality=None, cache_size=256,
+                 measure_savings=False):
+        profile = PROVIDER_PROFILES[provider]
+        self.provider = provider
+        self.max_side = max_side if max_side is not None else profile["max_side"]
+        self.max_short_side = profile["max_short_side"]
+        self.image_format = image_format or profile["image_format"]
+        self.quality = quality if quality is not None else profile["quality"]
+        self.cache_size = cache_size
+        self.baseline_format = profile["baseline_format"]
+        # Costs one extra full-resolution encode per decoded frame
+        self.measure_savings = measure_savings
+        self._reset()
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        # encoded bytes -> base64 string, least recently used first
+        self._base64 = collections.OrderedDict()
+        self.stats = collections.Counter()
+
+    def __getstate__(self):
+        return {"provider": self.provider, "max_side": self.max_side, "max_short_side": self.max_short_side,
+                "image_format": self.image_format, "quality": self.quality, "cache_size": self.cache_size,
+                "baseline_format": self.baseline_format, "measure_savings": self.measure_savings}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset()
+
+    @property
+    def mime_type(self):
+        return IMAGE_FORMATS[self.image_format][1]
+
+    def _scale(self, height, width):
+        scale = 1.0
+        if self.max_side:
+            scale = min(scale, self.max_side / max(height, width))
+        if self.max_short_side:
+            scale = min(scale, self.max_short_side / min(height, width))
+        return scale
+
+    def _baseline_bytes(self, image):
+        # Size of the image encoded the way it was sent before, at source resolution
+        success, buffer = cv2.imencode(IMAGE_FORMATS[self.baseline_format][0], image)
+        return len(buffer) if success else None
+
+    def encode(self, image, baseline_bytes=None):
+        """
+        Resize a decoded BGR image for the provider and encode it.
+
+        baseline_bytes is the size the caller would have sent before (e.g. the
+        original file). If it is None and measure_savings is set, it is measured
+        by encoding the full-size image in the provider's baseline format.
+        """
+        if baseline_bytes is None and self.measure_savings:
+            baseline_bytes = self._baseline_bytes(image)
+        height, width = image.shape[:2]
+        scale = self._scale(height, width)
+        if scale < 1.0:
+            size = (max(1, round(width * scale)), max(1, round(height * scale)))
+            image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        extension, _, quality_flag = IMAGE_FORMATS[self.image_format]
+        params = [quality_flag, int(self.quality)] if quality_flag is not None else []
+        success, buffer = cv2.imencode(extension, image, params)
+        if not success:
+            raise ValueError(f"Failed to encode image as {self.image_format}")
+        data = buffer.tobytes()
+        self.record(baseline_bytes, len(data))
+        return data
+
+    def encode_file_bytes(self, data):
+        """Re-encode an image file's bytes; returns them unchanged if they can't be decoded."""
+        # Image files used to be sent as they are, so the file itself is the baseline
+        image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            self.record(len(data), len(data))
+            return data
+        return self.encode(image, baseline_bytes=len(data))
+
+    def to_base64(self, data):
+        """Base64 of encoded bytes, cached so repeated requests for the same payload are free."""
+        with self._lock:
+            text = self._base64.get(data)
+            if text is not None:
+                self._base64.move_to_end(data)
+                self.stats["reused"] += 1
+                return text
+        text = base64.b64encode(data).decode('utf-8')
+        with self._lock:
+            self._base64[data] = text
+            while len(self._base64) > self.cache_size:
+                self._base64.popitem(last=False)
+        return text
+
+    def record(self, baseline_bytes, sent_bytes):
+        """Count one payload; baseline_bytes is None when the old size wasn't measured."""
+        with self._lock:
+            self.stats["images"] += 1
+            self.stats["sent_bytes"] += sent_bytes
+            if baseline_bytes is not None:
+                self.stats["baseline_images"] += 1
+                self.stats["baseline_bytes"] += baseline_bytes
+                self.stats["baseline_sent_bytes"] += sent_bytes
+
+    def merge(self, stats):
+        """Add stats returned from an encoder copy used in another process."""
+        with self._lock:
+            self.stats.update(stats)
+
+    def summary(self):
+        with self._lock:
+            stats = dict(self.stats)
+        images = stats.get("images", 0)
+        sent = stats.get("sent_bytes", 0)
+        text = (f"Upload payloads: {images} images as {self.image_format} (max side {self.max_side}), "
+                f"{sent / 1024 ** 2:.1f} MB sent, {stats.get('reused', 0)} base64 payloads reused")
+        baseline = stats.get("baseline_bytes", 0)
+        if baseline:
+            compared = stats.get("baseline_sent_bytes", 0)
+            saved = 100.0 * (1 - compared / baseline)
+            text += (f"; {compared / 1024 ** 2:.1f} MB sent for {stats['baseline_images']} images that would have "
+                     f"been {baseline / 1024 ** 2:.1f} MB as full-size {self.baseline_format} or original files "
+                     f"({saved:.0f}% saved)")
+        return text
@@ -1,11 +1,16 @@
+import argparse
+import collections
+import copy
+import json
 import logging
 import os
-import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-import torch
-from huggingface_hub import snapshot_download
 from PIL import Image
-from transformers import AutoProcessor, LlavaForConditionalGeneration
+
+from caption_cache import DEFAULT_CACHE_DIR, DEFAULT_MAX_BYTES, CaptionCache
 
 # Setup logging
 logging.basicConfig(
@@ -16,110 +21,565 @@ logging.basicConfig(
 MODEL_NAME = "fancyfeast/llama-joycaption-alpha-two-hf-llava"
 MODEL_PATH = "models/llama-joycaption-alpha-two-hf-llava"
 VALID_IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".gif", ".tiff"}
-
-# Ensure model is downloaded
-if not os.path.exists(MODEL_PATH):
-    logging.info("Model not found. Downloading...")
-    os.makedirs("models", exist_ok=True)
-    snapshot_download(repo_id=MODEL_NAME, local_dir=MODEL_PATH)
-    logging.info("Download complete!")
-
-# Load model and processor
-logging.info("Loading model...")
-processor = AutoProcessor.from_pretrained(MODEL_PATH)
-llava_model = LlavaForConditionalGeneration.from_pretrained(
-    MODEL_PATH, torch_dtype=torch.float16, device_map="auto"
+SYSTEM_PROMPT = "You are a helpful image captioner."
+USER_PROMPT = "Write a long descriptive caption for this image in a formal tone. Include information about lighting. Include information about camera angle. Do NOT mention any text that is in the image."
+
+GENERATION_KWARGS = dict(
+    max_new_tokens=300,
+    do_sample=True,
+    suppress_tokens=None,
+    use_cache=True,
+    temperature=0.6,
+    top_k=None,
+    top_p=0.9,
 )
-llava_model.eval()
-logging.info("Model loaded successfully!")
+# Rough memory one extra image in a batch needs (vision features plus the KV cache
+# for prompt, image tokens and 300 new tokens), used to pick the batch size.
+BATCH_MEMORY_PER_IMAGE = 1.5 * 1024 ** 3
+MAX_AUTO_BATCH_SIZE = 16
+# Decoding and preprocessing one image is far quicker than generating its caption,
+# so a few threads are enough to keep the next batch ready.
+DEFAULT_LOAD_WORKERS = min(4, os.cpu_count() or 1)
+
+# Captions are cached on disk by image bytes, prompt, model and generation settings, so
+# re-runs skip generation. The cache is opened on first use by get_caption_cache();
+# set use_cache to False (--no_cache) to always generate, e.g. for a fresh sampled caption.
+use_cache = True
+cache_dir = DEFAULT_CACHE_DIR
+cache_max_bytes = DEFAULT_MAX_BYTES
+_caption_cache = None
+
+# Weight dtypes by torch name. They stay strings until load_model() so that importing this
+# module, or printing usage, doesn't import torch.
+DTYPES = ["float16", "bfloat16", "float32"]
+
+# Device and dtype name for get_model(); None picks them automatically. Set before the first call.
+model_device = None
+model_dtype = None
+# "int8" applies dynamic int8 quantization to the linear layers (CPU only); None keeps model_dtype.
+model_quantization = None
+QUANTIZATION_MODES = ["int8"]
+
+# The model is downloaded and loaded on first use by get_model(), so importing this
+# module or printing usage doesn't wait for several GB to load.
+_processor = None
+_llava_model = None
+_model_lock = threading.Lock()
+_tokenizer_lock = threading.Lock()
+
+# The templated prompt and its token ids (per preprocessed image shape) are built once per run.
+_prompt = None
+_prompt_ids = {}
+
+# Reuse the KV cache of the prompt text before the image across images. It is
+# checked against a full prefill on the first batch; _prefix_supported stays
+# None until then.
+reuse_prefix = True
+_prefix_supported = None
+# (batch size, prefix token ids) -> prefix KV cache
+_prefix_caches = {}
+
+
+def select_device():
+    import torch
+
+    if torch.cuda.is_available():
+        return "cuda"
+    if getattr(torch.backends, "mps", None) is not None and torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+
+def cpu_supports_bf16():
+    # Native bf16 matmuls (AVX512-BF16 or AMX) make bf16 faster than fp32; without them it is slower.
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
 
 
-def describe_image(image_path):
+def select_dtype(device):
+    # Returns a DTYPES name
+    import torch
+
+    if device == "cuda":
+        return "bfloat16" if torch.cuda.is_bf16_supported() else "float16"
+    if device == "mps":
+        return "float16"
+    return "bfloat16" if cpu_supports_bf16() else "float32"
+
+
+def quantize_dynamic_int8(llava_model):
     """
-    Generate a descriptive caption for an image using JoyCaption2 and save it to a .txt file.
+    Replace every nn.Linear with a dynamically quantized int8 version.
+
+    Weights are stored as int8 and activations are quantized per batch at run
+    time, which roughly quarters the memory of the linear layers and speeds up
+    their matmuls on CPUs with VNNI. Only fp32 CPU models can be quantized this way.
+    """
+    import torch
+    from torch.ao.quantization import quantize_dynamic
+
+    # inplace: the default deep-copies the model first, holding two fp32 copies at once
+    return quantize_dynamic(llava_model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+def load_model(device=None, dtype=None, quantization=None):
+    """
+    Download (if needed) and load the processor and model.
 
     Args:
-        image_path (str): Path to the image file.
+        device (str, optional): "cuda", "mps" or "cpu"; picked automatically if None.
+        dtype (str, optional): Weight dtype, one of DTYPES; picked for the device if None
+            (bf16 or fp16 on GPU, bf16 on CPUs with native support, else fp32).
+        quantization (str, optional): "int8" for dynamic int8 linear layers; implies cpu and fp32.
 
     Returns:
-        None
+        tuple: (processor, model)
     """
-    if not os.path.exists(image_path):
-        logging.error(f"Error: Image file '{image_path}' not found!")
-        return
+    # torch and transformers take seconds to import, so they are only imported once the model is needed.
+    import torch
+    from huggingface_hub import snapshot_download
+    from transformers import AutoProcessor, LlavaForConditionalGeneration
+
+    if quantization == "int8":
+        if device not in (None, "cpu") or dtype not in (None, "float32"):
+            raise ValueError("int8 quantization runs on cpu with float32 activations only")
+        device, dtype = "cpu", "float32"
+    device = device or select_device()
+    dtype = dtype or select_dtype(device)
+
+    # Ensure model is downloaded
+    if not os.path.exists(MODEL_PATH):
+        logging.info("Model not found. Downloading...")
+        os.makedirs("models", exist_ok=True)
+        snapshot_download(repo_id=MODEL_NAME, local_dir=MODEL_PATH)
+        logging.info("Download complete!")
+
+    # Load model and processor
+    logging.info(f"Loading model on {device} as {dtype}...")
+    processor = AutoProcessor.from_pretrained(MODEL_PATH)
+    if device == "cuda":
+        llava_model = LlavaForConditionalGeneration.from_pretrained(
+            MODEL_PATH, torch_dtype=getattr(torch, dtype), device_map="auto"
+        )
+    else:
+        llava_model = LlavaForConditionalGeneration.from_pretrained(
+            MODEL_PATH, torch_dtype=getattr(torch, dtype), low_cpu_mem_usage=True
+        ).to(device)
+    llava_model.eval()
+    if quantization == "int8":
+        logging.info("Quantizing linear layers to int8...")
+        llava_model = quantize_dynamic_int8(llava_model)
+    # Batched prompts are padded on the left so every row ends where generation starts.
+    processor.tokenizer.padding_side = "left"
+    logging.info("Model loaded successfully!")
+    return processor, llava_model
+
+
+def get_model():
+    """Return (processor, model), loading them on the first call."""
+    global _processor, _llava_model
+    with _model_lock:
+        if _llava_model is None:
+            _processor, _llava_model = load_model(model_device, model_dtype, model_quantization)
+        return _processor, _llava_model
+
+
+def get_caption_cache():
+    """The caption cache, opened on the first call; None if caching is off."""
+    global _caption_cache
+    if use_cache and _caption_cache is None:
+        _caption_cache = CaptionCache(cache_dir, cache_max_bytes)
+    return _caption_cache if use_cache else None
+
+
+def cache_model_name():
+    # Precision and generation settings change the captions too, so they are part of the key.
+    # The dtype is resolved the way load_model() will, without loading the model.
+    if model_quantization:
+        precision = model_quantization
+    else:
+        precision = model_dtype or select_dtype(model_device or select_device())
+    return f"{MODEL_NAME}:{precision}:{json.dumps(GENERATION_KWARGS, sort_keys=True)}"
 
+
+def available_memory(device):
+    """Free memory in bytes on the device the model runs on."""
+    if device.type == "cuda":
+        import torch
+
+        free, _ = torch.cuda.mem_get_info(device)
+        return free
+    # MemAvailable counts reclaimable page cache, unlike the free page count
     try:
-        # Load and preprocess the image
-        image = Image.open(image_path).convert("RGB")
-
-        # Build the conversation prompt
-        convo = [
-            {"role": "system", "content": "You are a helpful image captioner."},
-            {
-                "role": "user",
-                "content": "Write a long descriptive caption for this image in a formal tone. Include information about lighting. Include information about camera angle. Do NOT mention any text that is in the image.",
-            },
-        ]
-
-        # Format conversation for LLaVA
-        convo_string = processor.apply_chat_template(
-            convo, tokenize=False, add_generation_prompt=True
-        )
-        assert isinstance(convo_string, str)
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return BATCH_MEMORY_PER_IMAGE
 
-        # Process the inputs
-        inputs = processor(text=[convo_string], images=[image], return_tensors="pt").to(
-            "cuda"
-        )
-        inputs["pixel_values"] = inputs["pixel_values"].to(torch.float16)
 
-        # Ensure tensors are valid
-        if (
-            torch.isnan(inputs["pixel_values"]).any()
-            or torch.isinf(inputs["pixel_values"]).any()
-        ):
-            logging.error("Error: Input tensor contains NaN or Inf values.")
-            return
+def auto_batch_size(device):
+    """Largest batch that fits in free memory, keeping a quarter of it in reserve."""
+    usable = available_memory(device) * 0.75
+    return max(1, min(MAX_AUTO_BATCH_SIZE, int(usable // BATCH_MEMORY_PER_IMAGE)))
+
+
+def build_prompt(processor):
+    # Build the conversation prompt
+    convo = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {
+            "role": "user",
+            "content": USER_PROMPT,
+        },
+    ]
+
+    # Format conversation for LLaVA
+    convo_string = processor.apply_chat_template(
+        convo, tokenize=False, add_generation_prompt=True
+    )
+    assert isinstance(convo_string, str)
+    return convo_string
+
 
-        # Generate caption
+def get_prompt(processor):
+    """The templated conversation, built once per run."""
+    global _prompt
+    if _prompt is None:
+        _prompt = build_prompt(processor)
+    return _prompt
+
+
+def prompt_ids(processor, image, pixel_values):
+    """
+    Token ids of the prompt for one image.
+
+    The processor expands the image placeholder to one token per vision patch,
+    so the ids depend only on the preprocessed image shape; they are tokenized
+    once per shape and shared by every image after that.
+    """
+    shape = tuple(pixel_values.shape[1:])
+    # Fast tokenizers raise "Already borrowed" when used from several threads at once
+    with _tokenizer_lock:
+        input_ids = _prompt_ids.get(shape)
+        if input_ids is None:
+            input_ids = processor(text=[get_prompt(processor)], images=[image], return_tensors="pt")["input_ids"]
+            _prompt_ids[shape] = input_ids
+    return input_ids
+
+
+def prepare_image(processor, image_path):
+    """Load and preprocess one image; returns CPU tensors ready to collate."""
+    image = Image.open(image_path).convert("RGB")
+    inputs = dict(processor.image_processor(images=[image], return_tensors="pt"))
+    inputs["input_ids"] = prompt_ids(processor, image, inputs["pixel_values"])
+    return inputs
+
+
+def collate_inputs(processor, rows):
+    """Stack single-image inputs into one batch, left-padding the prompts if their lengths differ."""
+    import torch
+
+    token_ids = [row["input_ids"][0] for row in rows]
+    if all(len(ids) == len(token_ids[0]) for ids in token_ids):
+        input_ids = torch.stack(token_ids)
+        batch = {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+    else:
+        with _tokenizer_lock:
+            batch = dict(processor.tokenizer.pad(
+                {"input_ids": [ids.tolist() for ids in token_ids]}, padding=True, return_tensors="pt"
+            ))
+    for key in rows[0]:
+        if key not in ("input_ids", "attention_mask"):
+            batch[key] = torch.cat([row[key] for row in rows])
+    return batch
+
+
+def prefix_length(processor, input_ids):
+    # Everything before the first image token is the same text for every image
+    image_token_id = processor.tokenizer.convert_tokens_to_ids(getattr(processor, "image_token", "<image>"))
+    positions = (input_ids[0] == image_token_id).nonzero()
+    return int(positions[0]) if len(positions) else 0
+
+
+def prefix_kv(llava_model, prefix, batch_size):
+    """KV cache of the shared prompt prefix for batch_size rows, computed once per batch size."""
+    import torch
+    from transformers import DynamicCache
+
+    key = (batch_size, tuple(prefix.tolist()))
+    cache = _prefix_caches.get(key)
+    if cache is None:
+        prefix_ids = prefix.unsqueeze(0).repeat(batch_size, 1)
         with torch.no_grad():
-            generate_ids = llava_model.generate(
-                **inputs,
-                max_new_tokens=300,
-                do_sample=True,
-                suppress_tokens=None,
-                use_cache=True,
-                temperature=0.6,
-                top_k=None,
-                top_p=0.9,
-            )[0]
-
-        # Trim the prompt from output
-        generate_ids = generate_ids[inputs["input_ids"].shape[1] :]
-
-        # Decode and clean up caption
-        caption = processor.tokenizer.decode(
-            generate_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False
-        ).strip()
-
-        # Save caption to a .txt file in the same directory as the image
-        output_file = os.path.splitext(image_path)[0] + ".txt"
-        with open(output_file, "w", encoding="utf-8") as f:
-            f.write(caption)
+            cache = llava_model(
+                input_ids=prefix_ids, attention_mask=torch.ones_like(prefix_ids),
+                past_key_values=DynamicCache(), use_cache=True,
+            ).past_key_values
+        _prefix_caches[key] = cache
+    return cache
 
-        logging.info(f"🖼️ Caption saved to: {output_file}")
 
+def prefix_reuse_works(llava_model, inputs, prefix):
+    """
+    Check once that generating on top of a prefix cache gives the same first token logits.
+
+    Some transformers versions only pass pixel_values to LLaVA when generation
+    starts from an empty cache, which would silently caption without the image.
+    """
+    import torch
+
+    row = {key: value[:1] for key, value in inputs.items()}
+    check_kwargs = dict(max_new_tokens=1, do_sample=False, output_logits=True, return_dict_in_generate=True)
+    try:
+        with torch.no_grad():
+            full = llava_model.generate(**row, **check_kwargs).logits[0].float()
+            reused = llava_model.generate(
+                **row, past_key_values=copy.deepcopy(prefix_kv(llava_model, prefix, 1)), **check_kwargs
+            ).logits[0].float()
     except Exception as e:
-        logging.error(f"Error generating caption: {e}")
-        logging.warning(f"No caption generated for: {image_path}")
+        logging.warning(f"Prompt prefix reuse is not supported here ({e}); computing the full prompt for each image")
+        return False
+    # Loose tolerance: bf16 rounds the prefix slightly differently when computed on its own
+    if (full - reused).abs().max() > 0.05 * full.abs().max():
+        logging.warning("Prompt prefix reuse changes the model output here; computing the full prompt for each image")
+        return False
+    logging.info(f"Reusing the KV cache of the {len(prefix)}-token prompt prefix across images")
+    return True
+
+
+def shared_prefix_cache(processor, llava_model, inputs):
+    """A fresh copy of the shared prefix KV cache for this batch, or None if it can't be used."""
+    global _prefix_supported
+    if not reuse_prefix or _prefix_supported is False:
+        return None
+    # Left padding would shift the prefix to different positions in each row
+    if not bool(inputs["attention_mask"].all()):
+        return None
+    input_ids = inputs["input_ids"]
+    length = prefix_length(processor, input_ids)
+    if length == 0:
+        return None
+    prefix = input_ids[0, :length]
+    if _prefix_supported is None:
+        _prefix_supported = prefix_reuse_works(llava_model, inputs, prefix)
+        if not _prefix_supported:
+            return None
+    # generate() appends to the cache it is given, so every batch gets its own copy
+    return copy.deepcopy(prefix_kv(llava_model, prefix, len(input_ids)))
+
+
+def generate_captions(inputs):
+    """
+    Caption a collated batch in one generate call.
+
+    Every row uses the same conversation, so only the image differs; generation
+    starts from the cached KV state of the shared prompt prefix when that works,
+    and each output row is trimmed and decoded on its own.
+
+    Returns:
+        list: One caption per row, or None for rows whose tensors were invalid.
+    """
+    import torch
+
+    processor, llava_model = get_model()
+    inputs = {key: value.to(llava_model.device) for key, value in inputs.items()}
+    inputs["pixel_values"] = inputs["pixel_values"].to(llava_model.dtype)
+
+    # Ensure tensors are valid; rows with NaN or Inf are dropped from the batch
+    pixel_values = inputs["pixel_values"]
+    valid = ~(torch.isnan(pixel_values) | torch.isinf(pixel_values)).flatten(1).any(dim=1)
+    captions = [None] * len(pixel_values)
+    if not valid.all():
+        logging.error(f"Error: Input tensors for {int((~valid).sum())} image(s) contain NaN or Inf values.")
+    if not valid.any():
+        return captions
+    if not valid.all():
+        inputs = {key: value[valid] for key, value in inputs.items()}
+
+    # Generate captions, starting from the cached prompt prefix where possible
+    generate_kwargs = dict(GENERATION_KWARGS)
+    prefix_cache = shared_prefix_cache(processor, llava_model, inputs)
+    if prefix_cache is not None:
+        generate_kwargs["past_key_values"] = prefix_cache
+    with torch.no_grad():
+        generate_ids = llava_model.generate(**inputs, **generate_kwargs)
+
+    # Trim the prompt from output; left padding gives every row the same prompt length
+    generate_ids = generate_ids[:, inputs["input_ids"].shape[1] :]
+
+    # Decode and clean up each caption separately
+    rows = iter(generate_ids)
+    for i, ok in enumerate(valid.tolist()):
+        if ok:
+            captions[i] = processor.tokenizer.decode(
+                next(rows), skip_special_tokens=True, clean_up_tokenization_spaces=False
+            ).strip()
+    return captions
+
+
+def save_caption(image_path, caption):
+    # Save caption to a .txt file in the same directory as the image
+    output_file = os.path.splitext(image_path)[0] + ".txt"
+    with open(output_file, "w", encoding="utf-8") as f:
+        f.write(caption)
+    return output_file
+
+
+def caption_paths(image_paths, batch_size=None, load_workers=DEFAULT_LOAD_WORKERS):
+    """
+    Generate captions for image files in batches, without touching the cache or writing files.
+
+    Images are decoded and preprocessed on load_workers background threads, which
+    keep the next batch ready while the model generates the current one.
 
+    Args:
+        image_paths (list): Paths to image files.
+        batch_size (int, optional): Images per generate call; picked from free memory if None.
+        load_workers (int): Threads loading and preprocessing images ahead of generation.
+
+    Yields:
+        tuple: (image_path, caption) in order of completion; caption is None if it failed.
+    """
+    import torch
+
+    processor, llava_model = get_model()
+    if batch_size is None:
+        batch_size = auto_batch_size(llava_model.device)
+        logging.info(f"Using batch size {batch_size} on {llava_model.device}")
+
+    generate_seconds = 0.0
+    wait_seconds = 0.0
+    with ThreadPoolExecutor(max_workers=max(1, load_workers)) as pool:
+        # (image_path, future) for images submitted for loading, in order.
+        # The current batch plus one more is kept in flight.
+        queued = collections.deque()
+        upcoming = iter(image_paths)
+
+        def fill():
+            while len(queued) < 2 * batch_size:
+                image_path = next(upcoming, None)
+                if image_path is None:
+                    return
+                queued.append((image_path, pool.submit(prepare_image, processor, image_path)))
+
+        fill()
+        while queued:
+            batch = [queued.popleft() for _ in range(min(batch_size, len(queued)))]
+            fill()
+
+            started = time.monotonic()
+            rows = []
+            for image_path, future in batch:
+                try:
+                    rows.append((image_path, future, future.result()))
+                except Exception as e:
+                    logging.error(f"Error loading '{image_path}': {e}")
+                    yield image_path, None
+            wait_seconds += time.monotonic() - started
+            if not rows:
+                continue
+
+            started = time.monotonic()
+            try:
+                captions = generate_captions(collate_inputs(processor, [row[2] for row in rows]))
+            except torch.cuda.OutOfMemoryError:
+                if batch_size == 1:
+                    raise
+                torch.cuda.empty_cache()
+                batch_size = max(1, batch_size // 2)
+                logging.warning(f"Out of memory; retrying with batch size {batch_size}")
+                # The images are already preprocessed; put them back at the front of the queue
+                for image_path, future, _ in reversed(rows):
+                    queued.appendleft((image_path, future))
+                continue
+            except Exception as e:
+                logging.error(f"Error generating captions: {e}")
+                captions = [None] * len(rows)
+            finally:
+                generate_seconds += time.monotonic() - started
+
+            for (image_path, *_), caption in zip(rows, captions):
+                yield image_path, caption
+
+    logging.info(f"Generation took {generate_seconds:.1f}s; {wait_seconds:.1f}s spent waiting for images to load")
+
+
+def describe_images(image_paths, batch_size=None, load_workers=DEFAULT_LOAD_WORKERS):
+    """
+    Caption images in batches and save each caption to a .txt file next to its image.
+
+    Args:
+        image_paths (list): Paths to image files.
+        batch_size (int, optional): Images per generate call; picked from free memory if None.
+        load_workers (int): Threads loading and preprocessing images ahead of generation.
 
-def process_directory(directory_path):
+    Returns:
+        None
+    """
+    caption_cache = get_caption_cache()
+    model_name = cache_model_name()
+    cache_keys = {}
+    for image_path in image_paths:
+        if not os.path.exists(image_path):
+            logging.error(f"Error: Image file '{image_path}' not found!")
+            continue
+        try:
+            with open(image_path, "rb") as f:
+                cache_key = CaptionCache.make_key([f.read()], SYSTEM_PROMPT + "\n" + USER_PROMPT, model_name)
+        except OSError as e:
+            logging.error(f"Error reading '{image_path}': {e}")
+            continue
+        caption = caption_cache.get(cache_key) if caption_cache is not None else None
+        if caption is not None:
+            output_file = save_caption(image_path, caption)
+            logging.info(f"🖼️ Cached caption saved to: {output_file}")
+            continue
+        cache_keys[image_path] = cache_key
+
+    if not cache_keys:
+        return
+
+    for image_path, caption in caption_paths(list(cache_keys), batch_size, load_workers):
+        if caption is None:
+            logging.warning(f"No caption generated for: {image_path}")
+            continue
+        if caption_cache is not None:
+            caption_cache.put(cache_keys[image_path], caption)
+        output_file = save_caption(image_path, caption)
+        logging.info(f"🖼️ Caption saved to: {output_file}")
+
+
+def describe_image(image_path):
+    """
+    Generate a descriptive caption for an image using JoyCaption2 and save it to a .txt file.
+
+    Args:
+        image_path (str): Path to the image file.
+
+    Returns:
+        None
+    """
+    describe_images([image_path], batch_size=1)
+
+
+def process_directory(directory_path, batch_size=None, load_workers=DEFAULT_LOAD_WORKERS):
     """
     Process all images in a directory and generate captions for each.
 
     Args:
         directory_path (str): Path to the directory containing images.
+        batch_size (int, optional): Images per generate call; picked from free memory if None.
+        load_workers (int): Threads loading and preprocessing images ahead of generation.
 
     Returns:
         None
@@ -140,18 +600,46 @@ def process_directory(directory_path):
 
     logging.info(f"Processing {len(image_files)} images in '{directory_path}'...\n")
 
-    for image_file in image_files:
-        describe_image(image_file)
+    describe_images(image_files, batch_size, load_workers)
 
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python utils/describe-image.py <image_path_or_folder>")
-        sys.exit(1)
-
-    path = sys.argv[1]
-
-    if os.path.isdir(path):
-        process_directory(path)
+    parser = argparse.ArgumentParser(description="Caption an image or every image in a folder with JoyCaption2.")
+    parser.add_argument("path", help="Image file or folder of images")
+    parser.add_argument("--batch_size", type=int, default=None,
+                        help="Images captioned per generate call (default: as many as fit in free memory)")
+    parser.add_argument("--load_workers", type=int, default=DEFAULT_LOAD_WORKERS,
+                        help=f"Threads loading and preprocessing upcoming images during generation (default: {DEFAULT_LOAD_WORKERS})")
+    parser.add_argument("--device", choices=["auto", "cuda", "mps", "cpu"], default="auto",
+                        help="Where to run the model (default: cuda, then mps, then cpu)")
+    parser.add_argument("--dtype", choices=["auto"] + DTYPES, default="auto",
+                        help="Model weight dtype (default: bf16/fp16 on GPU, bf16 or fp32 on CPU)")
+    parser.add_argument("--quantize", choices=QUANTIZATION_MODES, default=None,
+                        help="int8: dynamic int8 quantization of the linear layers, for CPU-only hosts")
+    parser.add_argument("--cache_dir", default=DEFAULT_CACHE_DIR,
+                        help=f"Directory for cached captions (default {DEFAULT_CACHE_DIR})")
+    parser.add_argument("--cache_max_gb", type=float, default=DEFAULT_MAX_BYTES / 1024 ** 3,
+                        help="Size cap for the caption cache; least recently used entries are evicted (default 1)")
+    parser.add_argument("--no_cache", action="store_true",
+                        help="Always generate new captions, ignoring and not storing cached ones")
+    parser.add_argument("--no_prefix_reuse", action="store_true",
+                        help="Recompute the shared prompt text for every image instead of reusing its KV cache")
+    args = parser.parse_args()
+    if args.quantize == "int8" and (args.device not in ("auto", "cpu") or args.dtype not in ("auto", "float32")):
+        parser.error("--quantize int8 runs on --device cpu with --dtype float32 only")
+
+    model_device = None if args.device == "auto" else args.device
+    model_dtype = None if args.dtype == "auto" else args.dtype
+    model_quantization = args.quantize
+    reuse_prefix = not args.no_prefix_reuse
+    use_cache = not args.no_cache
+    cache_dir = args.cache_dir
+    cache_max_bytes = int(args.cache_max_gb * 1024 ** 3)
+
+    if os.path.isdir(args.path):
+        process_directory(args.path, args.batch_size, args.load_workers)
     else:
-        describe_image(path)
+        describe_image(args.path)
+
+    if _caption_cache is not None:
+        logging.info(_caption_cache.summary())
@@ -0,0 +1,182 @@
+"""
+Compare JoyCaption2 precision modes on CPU: speed, memory and caption quality.
+
+Every mode runs in its own subprocess, so its memory is measured on its own.
+Peak RSS includes loading the model (int8 loads fp32 weights before quantizing
+them); loaded RSS is read after loading and quantization, and is what the mode
+needs while captioning. Captions are generated greedily, so each mode
+gives the same output on every run. They are then compared word by word with a
+reference run, which can be one of the modes in this run or a results file
+saved earlier.
+
+Usage:
+    python captioners/joycaption_benchmark.py data/images --modes fp32,bf16,int8 --limit 20
+"""
+
+import argparse
+import difflib
+import gc
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import joycaption2
+
+# mode -> (dtype name, quantization)
+BENCHMARK_MODES = {
+    "fp32": ("float32", None),
+    "bf16": ("bfloat16", None),
+    "int8": ("float32", "int8"),
+}
+
+
+def list_images(path, limit):
+    if os.path.isfile(path):
+        return [path]
+    image_files = sorted(
+        os.path.join(path, f)
+        for f in os.listdir(path)
+        if os.path.splitext(f)[1].lower() in joycaption2.VALID_IMAGE_EXTENSIONS
+    )
+    return image_files[:limit] if limit else image_files
+
+
+def peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def current_rss_bytes():
+    # Resident memory right now, from /proc (Linux); None where it isn't available
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def run_mode(mode, image_paths, batch_size, load_workers):
+    """Caption image_paths in one mode in this process and return the measurements."""
+    import torch
+
+    dtype_name, quantization = BENCHMARK_MODES[mode]
+    joycaption2.model_device = "cpu"
+    joycaption2.model_dtype = dtype_name
+    joycaption2.model_quantization = quantization
+    # Greedy decoding, so differences between modes come from precision rather than sampling
+    joycaption2.GENERATION_KWARGS = dict(joycaption2.GENERATION_KWARGS, do_sample=False, temperature=None, top_p=None)
+    torch.manual_seed(0)
+
+    started = time.monotonic()
+    joycaption2.get_model()
+    load_seconds = time.monotonic() - started
+    gc.collect()
+    loaded_rss = current_rss_bytes()
+
+    started = time.monotonic()
+    captions = dict(joycaption2.caption_paths(image_paths, batch_size, load_workers))
+    seconds = time.monotonic() - started
+
+    captioned = sum(caption is not None for caption in captions.values())
+    return {
+        "mode": mode,
+        "images": captioned,
+        "load_seconds": load_seconds,
+        "seconds": seconds,
+        "images_per_minute": 60.0 * captioned / seconds if seconds else 0.0,
+        "loaded_rss_bytes": loaded_rss,
+        "captioning_rss_bytes": current_rss_bytes(),
+        "peak_rss_bytes": peak_rss_bytes(),
+        "captions": captions,
+    }
+
+
+def caption_similarity(reference, captions):
+    """Mean word-level similarity (0-1) over images captioned in both runs."""
+    ratios = []
+    for image_path, caption in captions.items():
+        expected = reference.get(image_path)
+        if caption is None or expected is None:
+            continue
+        ratios.append(difflib.SequenceMatcher(None, expected.split(), caption.split()).ratio())
+    return sum(ratios) / len(ratios) if ratios else None
+
+
+def format_gb(value):
+    return f"{value / 1024 ** 3:.2f}" if value is not None else "n/a"
+
+
+def format_row(result, similarity):
+    similarity_text = f"{similarity:.3f}" if similarity is not None else "n/a"
+    return (f"{result['mode']:>6}  {result['images']:>6}  {result['images_per_minute']:>10.2f}  "
+            f"{result['load_seconds']:>8.1f}  {format_gb(result.get('loaded_rss_bytes')):>13}  "
+            f"{format_gb(result.get('captioning_rss_bytes')):>16}  {format_gb(result['peak_rss_bytes']):>11}  "
+            f"{similarity_text:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark JoyCaption2 precision modes on CPU.")
+    parser.add_argument("path", help="Image file or folder of images")
+    parser.add_argument("--modes", default="fp32,bf16,int8",
+                        help=f"Comma-separated modes to run, from: {', '.join(BENCHMARK_MODES)} (default: all)")
+    parser.add_argument("--reference", default="fp32",
+                        help="Mode of this run, or a results .json from an earlier run, to compare captions with "
+                             "(default: fp32)")
+    parser.add_argument("--limit", type=int, default=20, help="Caption only the first N images (0 for all)")
+    parser.add_argument("--batch_size", type=int, default=1, help="Images per generate call (default: 1)")
+    parser.add_argument("--load_workers", type=int, default=joycaption2.DEFAULT_LOAD_WORKERS,
+                        help="Threads loading and preprocessing images")
+    parser.add_argument("--results_dir", default="benchmark_results",
+                        help="Where each mode's measurements and captions are saved as <mode>.json")
+    parser.add_argument("--worker", choices=list(BENCHMARK_MODES), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    image_paths = list_images(args.path, args.limit)
+    if not image_paths:
+        parser.error(f"No valid images found in '{args.path}'")
+    os.makedirs(args.results_dir, exist_ok=True)
+
+    if args.worker:
+        result = run_mode(args.worker, image_paths, args.batch_size, args.load_workers)
+        with open(os.path.join(args.results_dir, f"{args.worker}.json"), "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+        return
+
+    modes = [mode.strip() for mode in args.modes.split(",") if mode.strip()]
+    unknown = [mode for mode in modes if mode not in BENCHMARK_MODES]
+    if unknown:
+        parser.error(f"Unknown mode(s): {', '.join(unknown)}")
+    if args.reference not in modes and not os.path.isfile(args.reference):
+        parser.error(f"--reference must be one of --modes or an existing results file: {args.reference}")
+
+    results = {}
+    for mode in modes:
+        logging.info(f"Benchmarking {mode} on {len(image_paths)} images...")
+        # Flags are passed on unchanged; only --worker is added
+        subprocess.run([sys.executable, os.path.abspath(__file__), *sys.argv[1:], "--worker", mode], check=True)
+        with open(os.path.join(args.results_dir, f"{mode}.json"), encoding="utf-8") as f:
+            results[mode] = json.load(f)
+
+    if args.reference in results:
+        reference = results[args.reference]["captions"]
+    else:
+        with open(args.reference, encoding="utf-8") as f:
+            reference = json.load(f)["captions"]
+
+    print(f"\nCaption similarity is measured against {args.reference}")
+    print(f"{'mode':>6}  {'images':>6}  {'images/min':>10}  {'load (s)':>8}  {'loaded RSS GB':>13}  "
+          f"{'after run RSS GB':>16}  {'peak RSS GB':>11}  {'similarity':>10}")
+    for mode in modes:
+        print(format_row(results[mode], caption_similarity(reference, results[mode]["captions"])))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,4 @@
-import base64
+import argparse
 import os
 import json
 import cv2
@@ -6,12 +6,33 @@ import numpy as np
 from openai import OpenAI
 from dotenv import load_dotenv
 
+from caption_cache import DEFAULT_CACHE_DIR, CaptionCache
+from image_payload import PayloadEncoder
+
 load_dotenv()
 
 client = OpenAI(
   api_key=os.environ.get("OPENAI_API_KEY")
 )
 
+MODEL = "gpt-4o-mini"
+
+parser = argparse.ArgumentParser(description="Caption every video in the current folder with OpenAI.")
+parser.add_argument("--cache_dir", default=DEFAULT_CACHE_DIR,
+                    help=f"Directory for cached caption replies (default {DEFAULT_CACHE_DIR})")
+parser.add_argument("--cache_max_gb", type=float, default=1.0,
+                    help="Size cap for the caption cache; least recently used entries are evicted (default 1)")
+parser.add_argument("--no_cache", action="store_true", help="Always call the API, ignoring cached replies")
+args = parser.parse_args()
+
+# Replies are cached on disk by image, prompt and model, so re-runs skip the API call.
+# The cache is opened when the first video needs a reply.
+caption_cache = None
+
+# Frames are downscaled to what high detail mode uses and sent as JPEG instead of PNG.
+# There is one frame per video, so also measuring the full-size PNG for the summary is cheap.
+payload_encoder = PayloadEncoder("openai", measure_savings=True)
+
 # Function to get the last frame from a video
 def get_last_frame(video_path):
     cap = cv2.VideoCapture(video_path)
@@ -32,10 +53,8 @@ def get_last_frame(video_path):
 
 # Function to encode the image from cv2 image
 def encode_image_from_cv2_image(cv2_image):
-    retval, buffer = cv2.imencode('.png', cv2_image)
-    # Convert to base64 encoding
-    base64_image = base64.b64encode(buffer).decode('utf-8')
-    return base64_image
+    # Resize and encode for upload, then convert to base64 encoding
+    return payload_encoder.to_base64(payload_encoder.encode(cv2_image))
 
 system_prompt = """
 You are a machine learning assistant tasked with labeling nsfw datasets.
@@ -81,7 +100,7 @@ for video_file in video_files:
                 {
                     "type": "image_url",
                     "image_url": {
-                        "url": f"data:image/png;base64,{base64_image}",
+                        "url": f"data:{payload_encoder.mime_type};base64,{base64_image}",
                         "detail": "high"
                     },
                 },
@@ -89,15 +108,21 @@ for video_file in video_files:
         }
     ]
 
-    # Make the API call
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=messages,
-        response_format={"type": "json_object"}
-    )
+    if caption_cache is None and not args.no_cache:
+        caption_cache = CaptionCache(args.cache_dir, int(args.cache_max_gb * 1024 ** 3))
+    cache_key = CaptionCache.make_key([base64_image], system_prompt, MODEL)
+    assistant_reply = caption_cache.get(cache_key) if caption_cache is not None else None
+    from_cache = assistant_reply is not None
+    if assistant_reply is None:
+        # Make the API call
+        response = client.chat.completions.create(
+            model=MODEL,
+            messages=messages,
+            response_format={"type": "json_object"}
+        )
 
-    # Get the assistant's reply
-    assistant_reply = response.choices[0].message.content
+        # Get the assistant's reply
+        assistant_reply = response.choices[0].message.content
 
     if assistant_reply is None:
         print(f"No reply received for {video_file}")
@@ -111,8 +136,16 @@ for video_file in video_files:
             print(f"Failed to parse JSON for {video_file}")
             caption = ""
 
+    # Only cache replies that parsed and contain a caption, so a bad reply is retried next run
+    if caption and not from_cache and caption_cache is not None:
+        caption_cache.put(cache_key, assistant_reply)
+
     # Save the caption to a .txt file with the same name as the video
     with open(txt_file, 'w', encoding='utf-8') as f:
         f.write(caption)
 
     print(f"Caption saved to {txt_file}")
+
+if caption_cache is not None:
+    print(caption_cache.summary())
+print(payload_encoder.summary())
@@ -0,0 +1,279 @@
+"""
+Process-wide request limiter for caption API calls.
+
+Each model gets its own token bucket (requests per minute) and an AIMD
+concurrency limit: every successful call raises the limit by 1/limit, and every
+rate-limit response halves it and empties the bucket. Callers block in acquire()
+until both a token and a concurrency slot are free, so however many threads are
+captioning, the number of requests actually in flight follows what the API
+accepts instead of piling into RESOURCE_EXHAUSTED errors.
+
+ModelHealth complements it across a fallback chain by skipping models that are
+cooling down after a rate-limit error.
+
+Both classes can be shared between threads and asyncio tasks: acquire() and
+route() block the calling thread, acquire_async() and route_async() only
+suspend the calling coroutine.
+"""
+
+import asyncio
+import collections
+import threading
+import time
+
+
+def is_rate_limit_error(error):
+    """Return True if an API exception looks like a quota / rate-limit response."""
+    err_str = str(error).lower()
+    return "resource_exhausted" in err_str or "rate limit" in err_str or "429" in err_str
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class _ModelState:
+    def __init__(self, rpm, initial_concurrency, max_concurrency, burst_seconds):
+        # rpm of 0 (or less) means no token bucket; only the concurrency limit applies
+        self.rate = rpm / 60.0 if rpm > 0 else None
+        self.capacity = max(1.0, self.rate * burst_seconds) if self.rate else 1.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.limit = float(initial_concurrency)
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+        self.waiting = 0
+        self.completed = collections.deque()
+        self.totals = collections.Counter()
+        self.async_waiters = collections.deque()
+
+    def refill(self, now):
+        if self.rate is None:
+            self.tokens = self.capacity
+            return
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class RateLimiter:
+    """
+    Token bucket plus AIMD concurrency limit per model name.
+
+    Usage:
+        rate_limiter.acquire(model_name)
+        outcome = "error"
+        try:
+            ...  # make the request, set outcome to "ok" or "rate_limited"
+        finally:
+            rate_limiter.release(model_name, outcome)
+    """
+
+    def __init__(self, rpm=60, initial_concurrency=4, max_concurrency=32, burst_seconds=5, model_rpm=None):
+        # rpm (and model_rpm values) of 0 disable the requests-per-minute cap for those models
+        self._cond = threading.Condition()
+        self._models = {}
+        self.configure(rpm, initial_concurrency, max_concurrency, burst_seconds, model_rpm)
+
+    def configure(self, rpm=60, initial_concurrency=4, max_concurrency=32, burst_seconds=5, model_rpm=None):
+        """Set limits; models seen after this call (or all, if none seen yet) use them."""
+        with self._cond:
+            self.rpm = rpm
+            self.initial_concurrency = initial_concurrency
+            self.max_concurrency = max_concurrency
+            self.burst_seconds = burst_seconds
+            self.model_rpm = dict(model_rpm or {})
+            self._models.clear()
+            self._started = time.monotonic()
+
+    def _state(self, model_name):
+        state = self._models.get(model_name)
+        if state is None:
+            state = _ModelState(
+                self.model_rpm.get(model_name, self.rpm),
+                min(self.initial_concurrency, self.max_concurrency),
+                self.max_concurrency,
+                self.burst_seconds,
+            )
+            self._models[model_name] = state
+        return state
+
+    def _try_acquire(self, model_name):
+        # Returns None once a slot is taken, otherwise how long to wait before retrying.
+        state = self._state(model_name)
+        now = time.monotonic()
+        state.refill(now)
+        if state.in_flight >= int(state.limit):
+            return 1.0  # woken early by release()
+        if state.tokens < 1.0:
+            return (1.0 - state.tokens) / state.rate
+        state.tokens -= 1.0
+        state.in_flight += 1
+        return None
+
+    def acquire(self, model_name):
+        """Block until a request to model_name may be sent."""
+        with self._cond:
+            state = self._state(model_name)
+            state.waiting += 1
+            try:
+                while True:
+                    wait = self._try_acquire(model_name)
+                    if wait is None:
+                        return
+                    self._cond.wait(wait)
+            finally:
+                state.waiting -= 1
+
+    async def acquire_async(self, model_name):
+        """Wait without blocking the event loop until a request to model_name may be sent."""
+        loop = asyncio.get_running_loop()
+        with self._cond:
+            state = self._state(model_name)
+            state.waiting += 1
+        try:
+            while True:
+                with self._cond:
+                    wait = self._try_acquire(model_name)
+                    if wait is None:
+                        return
+                    waiter = loop.create_future()
+                    state.async_waiters.append((loop, waiter))
+                # Woken by release() when a slot frees up, or after `wait` for tokens to refill
+                await asyncio.wait([waiter], timeout=wait)
+                with self._cond:
+                    if not waiter.done():
+                        waiter.cancel()
+        finally:
+            with self._cond:
+                state.waiting -= 1
+
+    def release(self, model_name, outcome="ok"):
+        """
+        Return the slot taken by acquire().
+
+        outcome is "ok" for any request the API accepted, "rate_limited" for
+        quota errors, and "error" for anything else (limit left unchanged).
+        """
+        with self._cond:
+            state = self._state(model_name)
+            state.in_flight = max(0, state.in_flight - 1)
+            state.totals[outcome] += 1
+            now = time.monotonic()
+            if outcome == "ok":
+                state.limit = min(state.max_concurrency, state.limit + 1.0 / state.limit)
+                state.completed.append(now)
+            elif outcome == "rate_limited":
+                state.limit = max(1.0, state.limit / 2.0)
+                state.tokens = 0.0
+            self._cond.notify_all()
+            # Wake the oldest coroutine still waiting; stale (timed-out) waiters are skipped.
+            while state.async_waiters:
+                loop, waiter = state.async_waiters.popleft()
+                if not waiter.done():
+                    loop.call_soon_threadsafe(_wake, waiter)
+                    break
+
+    def stats(self, window=60.0):
+        """Per-model snapshot: queue depth, in-flight, current limit, achieved req/s and totals."""
+        with self._cond:
+            now = time.monotonic()
+            span = max(1e-6, min(window, now - self._started))
+            snapshot = {}
+            for model_name, state in self._models.items():
+                while state.completed and now - state.completed[0] > window:
+                    state.completed.popleft()
+                snapshot[model_name] = {
+                    "waiting": state.waiting,
+                    "in_flight": state.in_flight,
+                    "limit": int(state.limit),
+                    "rps": len(state.completed) / span,
+                    "ok": state.totals["ok"],
+                    "rate_limited": state.totals["rate_limited"],
+                    "error": state.totals["error"],
+                }
+            return snapshot
+
+    def format_stats(self):
+        lines = []
+        for model_name, s in self.stats().items():
+            lines.append(
+                f"  {model_name}: queue={s['waiting']} in_flight={s['in_flight']}/{s['limit']} "
+                f"rps={s['rps']:.2f} ok={s['ok']} rate_limited={s['rate_limited']} error={s['error']}"
+            )
+        return "\n".join(lines)
+
+    def start_reporter(self, interval=30.0):
+        """Print stats every `interval` seconds from a daemon thread."""
+        def report():
+            while True:
+                time.sleep(interval)
+                text = self.format_stats()
+                if text:
+                    print(f"Rate limiter stats:\n{text}")
+
+        thread = threading.Thread(target=report, daemon=True)
+        thread.start()
+        return thread
+
+
+class ModelHealth:
+    """
+    Circuit breaker over a fallback model list.
+
+    A model that returns a rate-limit error is put on cooldown (doubling on each
+    consecutive strike, up to max_cooldown seconds) and skipped by route() until
+    the cooldown expires, so callers go straight to a model that is likely to
+    answer instead of paying a failed round trip to every exhausted one first.
+    """
+
+    def __init__(self, cooldown=30.0, max_cooldown=300.0):
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._lock = threading.Lock()
+        self._cooldown_until = {}
+        self._strikes = collections.Counter()
+
+    def mark_rate_limited(self, model_name):
+        with self._lock:
+            self._strikes[model_name] += 1
+            delay = min(self.max_cooldown, self.cooldown * 2 ** (self._strikes[model_name] - 1))
+            self._cooldown_until[model_name] = time.monotonic() + delay
+        print(f"Model {model_name} cooling down for {delay:.0f}s after rate limit.")
+
+    def mark_healthy(self, model_name):
+        with self._lock:
+            self._strikes.pop(model_name, None)
+            self._cooldown_until.pop(model_name, None)
+
+    def _healthy(self, model_list):
+        # Returns (healthy models, None, 0) or, if all are cooling down, ([], soonest, wait).
+        with self._lock:
+            now = time.monotonic()
+            healthy = [m for m in model_list if self._cooldown_until.get(m, 0) <= now]
+            if healthy or not model_list:
+                return healthy, None, 0
+            soonest = min(model_list, key=lambda m: self._cooldown_until[m])
+            return [], soonest, self._cooldown_until[soonest] - now
+
+    def route(self, model_list):
+        """
+        Return the models from model_list that are not cooling down, in priority
+        order. If every model is cooling down, wait for the first one to recover
+        and return just that model.
+        """
+        healthy, soonest, wait = self._healthy(model_list)
+        if soonest is None:
+            return healthy
+        print(f"All models cooling down; waiting {wait:.0f}s for {soonest}.")
+        time.sleep(wait)
+        return [soonest]
+
+    async def route_async(self, model_list):
+        """Coroutine version of route()."""
+        healthy, soonest, wait = self._healthy(model_list)
+        if soonest is None:
+            return healthy
+        print(f"All models cooling down; waiting {wait:.0f}s for {soonest}.")
+        await asyncio.sleep(wait)
+        return [soonest]
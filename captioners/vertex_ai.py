@@ -11,6 +11,10 @@ This script processes video files as follows:
 3. The script then writes the JSON output to a .json file and the "caption" text to a .txt file.
 4. On successful caption generation, the original video and output files are moved to the specified output directory.
 
+Files flow through a bounded pipeline: a validation pool feeds a queue of upload workers,
+which feed a queue of caption workers, so uploads and caption requests for different
+videos overlap instead of running one file at a time.
+
 Usage:
   python vertex_video_caption_extended.py \
     --dir /path/to/videos \
@@ -18,18 +22,30 @@ Usage:
     --project your-gcp-project-id \
     [--location us-central1] \
     [--prompt "Your custom prompt"] \
-    [--output_dir /path/to/output]
+    [--output_dir /path/to/output] \
+    [--validate_workers 4] [--upload_workers 4] [--caption_workers 8] [--queue_size 16] \
+    [--batch [--batch_model gemini-2.0-flash-001] [--batch_transport vertex|local]]
 """
 
 import argparse
+import base64
+import collections
+import concurrent.futures
+import hashlib
 import json
 import os
+import queue
 import shlex
 import shutil
 import subprocess
+import threading
+import time
 
+import google_crc32c
 import vertexai
+from google.api_core.exceptions import Forbidden, NotFound
 from google.cloud import storage
+from google.cloud.storage.retry import DEFAULT_RETRY
 from vertexai.generative_models import (
     GenerativeModel,
     GenerationConfig,
@@ -81,21 +97,77 @@ def validate_local_video(file_path):
     return True
 
 
-def upload_to_gcs(local_file, bucket_name, destination_blob_name=None):
+# Resumable uploads send the file in chunks of this size (a multiple of 256 KB); a
+# failed chunk is retried from the last byte GCS confirmed instead of from the start.
+DEFAULT_CHUNK_SIZE = 16 * 1024 * 1024
+CHUNK_ALIGNMENT = 256 * 1024
+
+# One storage client (and its HTTP connection pool) shared by every upload worker.
+_storage_client = None
+_storage_client_lock = threading.Lock()
+
+
+def get_storage_client():
+    global _storage_client
+    with _storage_client_lock:
+        if _storage_client is None:
+            _storage_client = storage.Client()
+        return _storage_client
+
+
+def local_checksums(local_file, block_size=8 * 1024 * 1024):
+    """Return (md5, crc32c) of a local file, base64 encoded like GCS object metadata."""
+    md5 = hashlib.md5()
+    crc = google_crc32c.Checksum()
+    with open(local_file, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            md5.update(block)
+            crc.update(block)
+    return base64.b64encode(md5.digest()).decode("ascii"), base64.b64encode(crc.digest()).decode("ascii")
+
+
+def upload_to_gcs(local_file, bucket_name, destination_blob_name=None, chunk_size=DEFAULT_CHUNK_SIZE):
     """
     Uploads a local file to the given GCS bucket and returns its GCS URI.
+
+    If an object with the same name and the same CRC32C (or MD5) already exists,
+    the upload is skipped.
     """
     if destination_blob_name is None:
         destination_blob_name = os.path.basename(local_file)
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(destination_blob_name)
-    blob.upload_from_filename(local_file)
+    bucket = get_storage_client().bucket(bucket_name)
     gcs_uri = f"gs://{bucket_name}/{destination_blob_name}"
+
+    try:
+        existing = bucket.get_blob(destination_blob_name)
+    except (Forbidden, NotFound):
+        # Credentials that may create objects but not read them (no
+        # storage.objects.get) cannot check for a copy; just upload.
+        existing = None
+    if existing is not None:
+        md5_hash, crc32c = local_checksums(local_file)
+        # Composite objects have no MD5, so CRC32C is checked first.
+        if (existing.crc32c and existing.crc32c == crc32c) or (existing.md5_hash and existing.md5_hash == md5_hash):
+            print(f"Skipping upload of {local_file}; {gcs_uri} already has the same content.")
+            return gcs_uri
+
+    chunk_size = max(CHUNK_ALIGNMENT, chunk_size // CHUNK_ALIGNMENT * CHUNK_ALIGNMENT)
+    blob = bucket.blob(destination_blob_name, chunk_size=chunk_size)
+    blob.upload_from_filename(local_file, checksum="crc32c", retry=DEFAULT_RETRY)
     print(f"Uploaded {local_file} to {gcs_uri}")
     return gcs_uri
 
 
+# Always-include adult-style instructions to ensure the model uses direct, natural adult language.
+ALWAYS_INCLUDE_INSTRUCTIONS = (
+    " IMPORTANT STYLE NOTE: Use normal adult language for sexual/pornographic descriptions. "
+    "For example, use 'butt' or 'ass' instead of 'bottom' or 'tushy.' "
+    "You may mention 'vagina' or 'labia' when appropriate, but avoid overly formal or childish terms. "
+    "Write as an adult describing adult content, not as a medical text or a prude. "
+    "Keep it direct and natural, without excessive or gratuitous vulgarity. "
+)
+
+
 def caption_video(gcs_uri, prompt_text, fallback_models):
     video_part = Part.from_uri(uri=gcs_uri, mime_type="video/mp4")
     safety_settings = [
@@ -109,15 +181,6 @@ def caption_video(gcs_uri, prompt_text, fallback_models):
         ),
     ]
 
-    # Always-include adult-style instructions to ensure the model uses direct, natural adult language.
-    ALWAYS_INCLUDE_INSTRUCTIONS = (
-        " IMPORTANT STYLE NOTE: Use normal adult language for sexual/pornographic descriptions. "
-        "For example, use 'butt' or 'ass' instead of 'bottom' or 'tushy.' "
-        "You may mention 'vagina' or 'labia' when appropriate, but avoid overly formal or childish terms. "
-        "Write as an adult describing adult content, not as a medical text or a prude. "
-        "Keep it direct and natural, without excessive or gratuitous vulgarity. "
-    )
-
     # Combine caller’s prompt with our forced style instructions, so it’s always appended.
     combined_prompt = f"{prompt_text}\n\n{ALWAYS_INCLUDE_INSTRUCTIONS}"
 
@@ -156,7 +219,73 @@ def caption_video(gcs_uri, prompt_text, fallback_models):
             raise Exception("All fallback models failed. Last error: " + str(last_exception))
 
 
-def process_video(file_path, bucket, prompt_text, output_dir, condition_text):
+# Optional low-resolution upload copy. The model samples video frames at low
+# resolution anyway, so a size- and bitrate-capped proxy captions the same while
+# uploading and storing a fraction of the bytes. Proxies are cached by source hash.
+ProxySettings = collections.namedtuple("ProxySettings", ["cache_dir", "max_side", "bitrate"])
+DEFAULT_PROXY_DIR = os.path.join(os.path.expanduser("~"), ".cache", "triplex", "proxies")
+
+
+def hash_file(file_path, block_size=8 * 1024 * 1024):
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def make_proxy(file_path, proxy):
+    """
+    Return the path of a proxy mp4 for file_path: longest side at most
+    proxy.max_side (never upscaled), video bitrate capped at proxy.bitrate and
+    mono 64k audio. A proxy for the same source content and settings is reused.
+    """
+    digest = hash_file(file_path)
+    proxy_path = os.path.join(proxy.cache_dir, digest[:2], f"{digest}_{proxy.max_side}_{proxy.bitrate}.mp4")
+    if os.path.exists(proxy_path):
+        print(f"Using cached proxy for {file_path}")
+        return proxy_path
+
+    os.makedirs(os.path.dirname(proxy_path), exist_ok=True)
+    side = proxy.max_side
+    scale = (f"scale=w='if(gte(iw,ih),trunc(min({side},iw)/2)*2,-2)'"
+             f":h='if(gte(iw,ih),-2,trunc(min({side},ih)/2)*2)'")
+    tmp_path = proxy_path + ".tmp.mp4"
+    cmd = [
+        "ffmpeg", "-y", "-v", "error", "-i", file_path,
+        "-vf", scale,
+        "-c:v", "libx264", "-preset", "veryfast",
+        "-b:v", proxy.bitrate, "-maxrate", proxy.bitrate, "-bufsize", proxy.bitrate,
+        "-pix_fmt", "yuv420p",
+        "-c:a", "aac", "-b:a", "64k", "-ac", "1",
+        "-movflags", "+faststart",
+        tmp_path,
+    ]
+    try:
+        subprocess.run(cmd, check=True, capture_output=True)
+    except subprocess.CalledProcessError as ffmpeg_err:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise RuntimeError(f"ffmpeg could not create a proxy for {file_path}: {ffmpeg_err.stderr}")
+    os.replace(tmp_path, proxy_path)
+    print(f"Created proxy for {file_path}: {os.path.getsize(file_path) / 1024 ** 2:.1f} MB -> "
+          f"{os.path.getsize(proxy_path) / 1024 ** 2:.1f} MB")
+    return proxy_path
+
+
+def upload_video(file_path, bucket, chunk_size=DEFAULT_CHUNK_SIZE, proxy=None):
+    """Upload file_path, or its proxy if proxy settings are given, and return the GCS URI."""
+    if proxy is None:
+        return upload_to_gcs(file_path, bucket, chunk_size=chunk_size)
+    proxy_path = make_proxy(file_path, proxy)
+    # Named after the original so objects stay recognisable; the hash suffix keeps different sources apart.
+    base_name = os.path.splitext(os.path.basename(file_path))[0]
+    blob_name = f"proxies/{base_name}_{os.path.basename(proxy_path)[:12]}.mp4"
+    return upload_to_gcs(proxy_path, bucket, blob_name, chunk_size=chunk_size)
+
+
+def process_video(file_path, bucket, prompt_text, output_dir, condition_text, chunk_size=DEFAULT_CHUNK_SIZE,
+                  proxy=None):
     """Upload the video file and obtain caption outputs, etc."""
     # ------------------- NEW VALIDATION STEP HERE ------------------- #
     if not validate_local_video(file_path):
@@ -164,11 +293,23 @@ def process_video(file_path, bucket, prompt_text, output_dir, condition_text):
         return  # or raise an Exception if you'd rather stop entirely
     # ----------------------------------------------------------------- #
 
-    base_name = os.path.splitext(os.path.basename(file_path))[0]
     # Proceed with upload now that the file is confirmed valid.
-    gcs_uri = upload_to_gcs(file_path, bucket)
+    gcs_uri = upload_video(file_path, bucket, chunk_size, proxy)
+    caption_uploaded_video(file_path, gcs_uri, prompt_text, output_dir, condition_text)
+
+
+def caption_uploaded_video(file_path, gcs_uri, prompt_text, output_dir, condition_text):
+    """Caption a video already uploaded to gcs_uri, then save (and optionally move) the outputs."""
     print(f"Requesting caption for {file_path} …")
+    combined_prompt = build_caption_prompt(prompt_text)
+    raw_response = caption_video(gcs_uri, combined_prompt, FALLBACK_MODELS)
+    print("Raw API response:")
+    print(raw_response)
+    save_caption_outputs(file_path, raw_response, output_dir)
 
+
+def build_caption_prompt(prompt_text):
+    """Caller's prompt plus the fixed JSON output instructions."""
     consistency_note = """
     IMPORTANT: The first time the specified condition is met MUST be stored
     in the 'metadata' object under the key "first_condition_timestamp" (an integer).
@@ -207,10 +348,12 @@ def process_video(file_path, bucket, prompt_text, output_dir, condition_text):
     {consistency_note}
     """
 
-    combined_prompt = f"{prompt_text}\n\n{rigid_json_prompt}"
-    raw_response = caption_video(gcs_uri, combined_prompt, FALLBACK_MODELS)
-    print("Raw API response:")
-    print(raw_response)
+    return f"{prompt_text}\n\n{rigid_json_prompt}"
+
+
+def save_caption_outputs(file_path, raw_response, output_dir):
+    """Write <basename>.json and .txt from a raw model response and move everything to output_dir."""
+    base_name = os.path.splitext(os.path.basename(file_path))[0]
 
     # Attempt to parse the response as JSON.
     try:
@@ -259,6 +402,298 @@ def process_video(file_path, bucket, prompt_text, output_dir, condition_text):
             print(f"Error moving files to output directory: {move_err}")
 
 
+class PipelineStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {"invalid": 0, "upload_failed": 0, "caption_failed": 0, "captioned": 0}
+
+    def add(self, key):
+        with self._lock:
+            self.counts[key] += 1
+
+    def summary(self):
+        with self._lock:
+            return ", ".join(f"{key}={value}" for key, value in self.counts.items())
+
+
+def run_pipeline(file_paths, bucket, prompt_text, output_dir, condition_text,
+                 validate_workers=4, upload_workers=4, caption_workers=8, queue_size=16,
+                 chunk_size=DEFAULT_CHUNK_SIZE, proxy=None):
+    """
+    Validate, upload and caption videos as three overlapping stages.
+
+    validate_workers check files in a thread pool and put valid ones on the upload
+    queue; upload_workers move them to GCS and put (file, uri) on the caption queue;
+    caption_workers request captions and write outputs. The queues are bounded by
+    queue_size, so a fast stage waits for a slow one instead of running far ahead.
+    With proxy settings, upload workers also build the proxy before uploading it.
+    A failure in any stage is reported and skips only that file.
+    """
+    upload_queue = queue.Queue(maxsize=queue_size)
+    caption_queue = queue.Queue(maxsize=queue_size)
+    stats = PipelineStats()
+    start = time.monotonic()
+
+    def validate_stage():
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=validate_workers) as executor:
+                futures = {executor.submit(validate_local_video, path): path for path in file_paths}
+                for future in concurrent.futures.as_completed(futures):
+                    path = futures[future]
+                    try:
+                        valid = future.result()
+                    except Exception as err:
+                        print(f"Error validating {path}: {err}")
+                        valid = False
+                    if valid:
+                        upload_queue.put(path)
+                    else:
+                        print(f"Skipping invalid video: {path}")
+                        stats.add("invalid")
+        finally:
+            for _ in range(upload_workers):
+                upload_queue.put(None)
+
+    def upload_worker():
+        while True:
+            path = upload_queue.get()
+            if path is None:
+                return
+            try:
+                caption_queue.put((path, upload_video(path, bucket, chunk_size, proxy)))
+            except Exception as err:
+                print(f"Error uploading {path}: {err}")
+                stats.add("upload_failed")
+
+    def caption_worker():
+        while True:
+            item = caption_queue.get()
+            if item is None:
+                return
+            path, gcs_uri = item
+            try:
+                caption_uploaded_video(path, gcs_uri, prompt_text, output_dir, condition_text)
+                stats.add("captioned")
+            except Exception as err:
+                print(f"Error processing {os.path.basename(path)}: {err}")
+                stats.add("caption_failed")
+
+    validator = threading.Thread(target=validate_stage)
+    uploaders = [threading.Thread(target=upload_worker) for _ in range(upload_workers)]
+    captioners = [threading.Thread(target=caption_worker) for _ in range(caption_workers)]
+    for thread in [validator] + uploaders + captioners:
+        thread.start()
+
+    validator.join()
+    for thread in uploaders:
+        thread.join()
+    for _ in range(caption_workers):
+        caption_queue.put(None)
+    for thread in captioners:
+        thread.join()
+
+    print(f"Pipeline finished in {time.monotonic() - start:.1f}s: {stats.summary()}")
+    return stats
+
+
+def build_batch_request(gcs_uri, prompt_text):
+    """One line of a Vertex AI batch prediction input file: the same request caption_video sends."""
+    return {
+        "request": {
+            "contents": [{
+                "role": "user",
+                "parts": [
+                    {"fileData": {"fileUri": gcs_uri, "mimeType": "video/mp4"}},
+                    {"text": f"{prompt_text}\n\n{ALWAYS_INCLUDE_INSTRUCTIONS}"},
+                ],
+            }],
+            "generationConfig": {"responseMimeType": "application/json", "temperature": 0.0},
+            "safetySettings": [
+                {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+                {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+            ],
+        }
+    }
+
+
+def batch_result_uri(result):
+    return result["request"]["contents"][0]["parts"][0]["fileData"]["fileUri"]
+
+
+def batch_result_text(result):
+    """Response text of one batch output line, or None if that request failed."""
+    if result.get("status"):
+        return None
+    try:
+        parts = result["response"]["candidates"][0]["content"]["parts"]
+    except (KeyError, IndexError):
+        return None
+    return "".join(part.get("text", "") for part in parts) or None
+
+
+class VertexBatchTransport:
+    """Stages videos and request files in GCS and runs them as a Vertex AI batch prediction job."""
+
+    def __init__(self, bucket, prefix="batch", chunk_size=DEFAULT_CHUNK_SIZE, proxy=None):
+        self.bucket = bucket
+        self.prefix = f"{prefix}/{time.strftime('%Y%m%d-%H%M%S')}"
+        self.chunk_size = chunk_size
+        self.proxy = proxy
+
+    def stage_video(self, file_path):
+        return upload_video(file_path, self.bucket, self.chunk_size, self.proxy)
+
+    def write_requests(self, requests):
+        blob_name = f"{self.prefix}/requests.jsonl"
+        blob = get_storage_client().bucket(self.bucket).blob(blob_name)
+        blob.upload_from_string("".join(json.dumps(request) + "\n" for request in requests),
+                                content_type="application/jsonl")
+        return f"gs://{self.bucket}/{blob_name}"
+
+    def submit(self, model, input_uri):
+        # Imported here so online captioning still works with SDK versions that predate batch prediction.
+        from vertexai.batch_prediction import BatchPredictionJob
+        job = BatchPredictionJob.submit(source_model=model, input_dataset=input_uri,
+                                        output_uri_prefix=f"gs://{self.bucket}/{self.prefix}/output")
+        print(f"Submitted batch job {job.resource_name}")
+        return job
+
+    def wait(self, job, poll_interval):
+        while not job.has_ended:
+            time.sleep(poll_interval)
+            job.refresh()
+            print(f"Batch job state: {job.state.name}")
+        if not job.has_succeeded:
+            raise RuntimeError(f"Batch job failed: {job.error}")
+
+    def read_results(self, job):
+        bucket_name, _, prefix = job.output_location[len("gs://"):].partition("/")
+        for blob in get_storage_client().list_blobs(bucket_name, prefix=prefix):
+            if blob.name.endswith(".jsonl"):
+                for line in blob.download_as_text().splitlines():
+                    if line.strip():
+                        yield json.loads(line)
+
+
+def local_batch_response(request):
+    # Placeholder answer in the expected JSON shape, used by LocalBatchTransport by default.
+    filename = os.path.basename(request["contents"][0]["parts"][0]["fileData"]["fileUri"])
+    return json.dumps({
+        "caption": f"Local batch caption for {filename}",
+        "timestamped_captions": [],
+        "metadata": {"filename": filename},
+        "confirmation": "",
+    })
+
+
+class LocalBatchTransport:
+    """
+    Offline stand-in for VertexBatchTransport. Videos stay on disk (file:// URIs)
+    and submit() answers each request with responder(request) instead of Vertex AI,
+    writing output lines in the same format, so the batch flow can be run without GCP.
+    """
+
+    def __init__(self, work_dir, responder=local_batch_response):
+        self.work_dir = work_dir
+        self.responder = responder
+        os.makedirs(work_dir, exist_ok=True)
+
+    def stage_video(self, file_path):
+        return "file://" + os.path.abspath(file_path)
+
+    def write_requests(self, requests):
+        input_path = os.path.join(self.work_dir, "requests.jsonl")
+        with open(input_path, "w", encoding="utf-8") as f:
+            for request in requests:
+                f.write(json.dumps(request) + "\n")
+        return input_path
+
+    def submit(self, model, input_uri):
+        output_path = os.path.join(self.work_dir, "predictions.jsonl")
+        with open(input_uri, "r", encoding="utf-8") as src, open(output_path, "w", encoding="utf-8") as dst:
+            for line in src:
+                request = json.loads(line)["request"]
+                try:
+                    text = self.responder(request)
+                    result = {"status": "", "request": request,
+                              "response": {"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}}]}}
+                except Exception as err:
+                    result = {"status": str(err), "request": request}
+                dst.write(json.dumps(result) + "\n")
+        return output_path
+
+    def wait(self, job, poll_interval):
+        pass
+
+    def read_results(self, job):
+        with open(job, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def run_batch(file_paths, transport, prompt_text, output_dir, model, poll_interval=60,
+              validate_workers=4, upload_workers=4):
+    """
+    Caption videos with one batch job instead of per-file online requests.
+
+    Valid videos are staged through the transport, written as a single JSONL
+    request file and submitted; once the job ends, each result is saved with
+    save_caption_outputs exactly as an online caption would be. Videos whose
+    request failed keep no outputs, so the next run picks them up again.
+    """
+    stats = PipelineStats()
+    start = time.monotonic()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=validate_workers) as executor:
+        valid = list(executor.map(validate_local_video, file_paths))
+    valid_paths = [path for path, ok in zip(file_paths, valid) if ok]
+    for path, ok in zip(file_paths, valid):
+        if not ok:
+            print(f"Skipping invalid video: {path}")
+            stats.add("invalid")
+
+    staged = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=upload_workers) as executor:
+        futures = {executor.submit(transport.stage_video, path): path for path in valid_paths}
+        for future in concurrent.futures.as_completed(futures):
+            path = futures[future]
+            try:
+                staged[future.result()] = path
+            except Exception as err:
+                print(f"Error uploading {path}: {err}")
+                stats.add("upload_failed")
+
+    if staged:
+        combined_prompt = build_caption_prompt(prompt_text)
+        input_uri = transport.write_requests([build_batch_request(uri, combined_prompt) for uri in staged])
+        print(f"Wrote {len(staged)} batch requests to {input_uri}")
+        job = transport.submit(model, input_uri)
+        transport.wait(job, poll_interval)
+
+        for result in transport.read_results(job):
+            path = staged.pop(batch_result_uri(result), None)
+            if path is None:
+                continue
+            raw_response = batch_result_text(result)
+            if raw_response is None:
+                print(f"Batch request for {path} failed: {result.get('status') or 'no response'}")
+                stats.add("caption_failed")
+                continue
+            try:
+                save_caption_outputs(path, raw_response, output_dir)
+                stats.add("captioned")
+            except Exception as err:
+                print(f"Error saving captions for {path}: {err}")
+                stats.add("caption_failed")
+        for path in staged.values():
+            print(f"No batch result for {path}")
+            stats.add("caption_failed")
+
+    print(f"Batch finished in {time.monotonic() - start:.1f}s: {stats.summary()}")
+    return stats
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Generate detailed JSON-formatted captions for videos using Vertex AI with fallback models. "
@@ -267,8 +702,8 @@ def main():
     )
 
     parser.add_argument("--dir", required=True, help="Directory containing video files")
-    parser.add_argument("--bucket", required=True, help="GCS bucket name to upload videos")
-    parser.add_argument("--project", required=True, help="Your GCP project id")
+    parser.add_argument("--bucket", help="GCS bucket name to upload videos")
+    parser.add_argument("--project", help="Your GCP project id")
     parser.add_argument("--location", default="us-central1", help="GCP region (default: us-central1)")
 
     # Updated default prompt: incorporate the requirement for JSON keys, but remain flexible for user overrides.
@@ -304,15 +739,50 @@ def main():
         help="Condition that the model should look for, e.g. 'the first time breasts are visible'"
     )
 
+    parser.add_argument("--validate_workers", type=int, default=4,
+                        help="Parallel ffprobe validations (default 4)")
+    parser.add_argument("--upload_workers", type=int, default=4,
+                        help="Parallel GCS uploads (default 4)")
+    parser.add_argument("--caption_workers", type=int, default=8,
+                        help="Parallel caption requests (default 8)")
+    parser.add_argument("--queue_size", type=int, default=16,
+                        help="Maximum videos waiting between pipeline stages (default 16)")
+    parser.add_argument("--proxy", action="store_true",
+                        help="Upload a low-resolution, bitrate-capped copy instead of the original video")
+    parser.add_argument("--proxy_max_side", type=int, default=768,
+                        help="Longest side of proxy videos in pixels (default 768)")
+    parser.add_argument("--proxy_bitrate", default="1M",
+                        help="Video bitrate cap of proxy videos, in ffmpeg notation (default 1M)")
+    parser.add_argument("--proxy_dir", default=DEFAULT_PROXY_DIR,
+                        help="Where proxies are cached by source hash (default ~/.cache/triplex/proxies)")
+    parser.add_argument("--chunk_size_mb", type=int, default=DEFAULT_CHUNK_SIZE // (1024 * 1024),
+                        help="Resumable upload chunk size in MB (default %(default)s)")
+
+    parser.add_argument("--batch", action="store_true",
+                        help="Submit all videos as one Vertex AI batch prediction job instead of online requests")
+    parser.add_argument("--batch_model", default="gemini-2.0-flash-001",
+                        help="Model for batch jobs; batch prediction needs a versioned model (default %(default)s)")
+    parser.add_argument("--poll_interval", type=float, default=60,
+                        help="Seconds between batch job status checks (default 60)")
+    parser.add_argument("--batch_transport", choices=["vertex", "local"], default="vertex",
+                        help="local answers batch requests offline with placeholder captions, for testing")
+    parser.add_argument("--batch_dir", default="batch_local",
+                        help="Working directory of the local batch transport (default batch_local)")
+
     args = parser.parse_args()
+    local_batch = args.batch and args.batch_transport == "local"
+    if not local_batch and not (args.bucket and args.project):
+        parser.error("--bucket and --project are required")
 
     # Initialize Vertex AI.
-    vertexai.init(project=args.project, location=args.location)
+    if not local_batch:
+        vertexai.init(project=args.project, location=args.location)
 
     # Supported video file extensions.
     video_exts = {".mp4", ".mov", ".m4v", ".avi", ".mpeg", ".wmv", ".flv", ".mpg", ".webm", ".3gpp"}
 
-    # Process each video file in the specified directory.
+    # Collect the video files in the specified directory.
+    file_paths = []
     for filename in os.listdir(args.dir):
         file_path = os.path.join(args.dir, filename)
         if not os.path.isfile(file_path):
@@ -320,14 +790,27 @@ def main():
 
         ext = os.path.splitext(filename)[1].lower()
         if ext in video_exts:
-            print(f"\nProcessing video file: {filename}")
-            try:
-                process_video(file_path, args.bucket, args.prompt, args.output_dir, args.condition)
-            except Exception as proc_err:
-                print(f"Error processing {filename}: {proc_err}")
+            file_paths.append(file_path)
         else:
             print(f"Skipping unsupported file type: {filename}")
 
+    print(f"\nProcessing {len(file_paths)} video files.")
+    chunk_size = args.chunk_size_mb * 1024 * 1024
+    proxy = ProxySettings(args.proxy_dir, args.proxy_max_side, args.proxy_bitrate) if args.proxy else None
+    if args.batch:
+        if local_batch:
+            transport = LocalBatchTransport(args.batch_dir)
+        else:
+            transport = VertexBatchTransport(args.bucket, chunk_size=chunk_size, proxy=proxy)
+        run_batch(file_paths, transport, args.prompt, args.output_dir, args.batch_model,
+                  poll_interval=args.poll_interval, validate_workers=args.validate_workers,
+                  upload_workers=args.upload_workers)
+    else:
+        run_pipeline(file_paths, args.bucket, args.prompt, args.output_dir, args.condition,
+                     validate_workers=args.validate_workers, upload_workers=args.upload_workers,
+                     caption_workers=args.caption_workers, queue_size=args.queue_size,
+                     chunk_size=chunk_size, proxy=proxy)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,72 @@
+import os
+import argparse
+import shutil
+import tempfile
+import time
+
+import cv2
+
+from output_clips_to_hunyuan_dataset import process_videos
+
+
+def decode_all(video_path):
+    cap = cv2.VideoCapture(video_path)
+    frames = 0
+    while True:
+        ret, _ = cap.read()
+        if not ret:
+            break
+        frames += 1
+    cap.release()
+    return frames
+
+
+def benchmark_backend(input_dir, output_dir, backend, workers, codec, crf):
+    start = time.perf_counter()
+    process_videos(input_dir, output_dir, workers=workers, backend=backend, codec=codec, crf=crf)
+    build_time = time.perf_counter() - start
+
+    videos_dir = os.path.join(output_dir, 'videos')
+    video_paths = [os.path.join(videos_dir, f) for f in sorted(os.listdir(videos_dir))]
+    total_bytes = sum(os.path.getsize(p) for p in video_paths)
+
+    start = time.perf_counter()
+    total_frames = sum(decode_all(p) for p in video_paths)
+    decode_time = time.perf_counter() - start
+
+    return {
+        'clips': len(video_paths),
+        'build_s': build_time,
+        'size_mb': total_bytes / (1024 * 1024),
+        'decode_s': decode_time,
+        'decode_fps': total_frames / decode_time if decode_time > 0 else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare the OpenCV and ffmpeg Hunyuan dataset backends on build time, output size and decode speed.'
+    )
+    parser.add_argument('--input_videos_dir', type=str, required=True, help='Path to a directory of sample clips')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes')
+    parser.add_argument('--codec', type=str, default='libx264', help='ffmpeg video codec')
+    parser.add_argument('--crf', type=int, default=18, help='ffmpeg constant rate factor')
+    args = parser.parse_args()
+
+    results = {}
+    for backend in ('opencv', 'ffmpeg'):
+        output_dir = tempfile.mkdtemp(prefix=f'hunyuan_bench_{backend}_')
+        try:
+            results[backend] = benchmark_backend(args.input_videos_dir, output_dir, backend,
+                                                 args.workers, args.codec, args.crf)
+        finally:
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+    print(f"{'backend':<8} {'clips':>6} {'build (s)':>10} {'size (MB)':>10} {'decode (s)':>11} {'decode fps':>11}")
+    for backend, r in results.items():
+        print(f"{backend:<8} {r['clips']:>6} {r['build_s']:>10.2f} {r['size_mb']:>10.2f} "
+              f"{r['decode_s']:>11.2f} {r['decode_fps']:>11.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,12 @@
 import os
 import argparse
+import hashlib
+import json
+import shutil
+import subprocess
+import traceback
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 import cv2
 import numpy as np
@@ -25,8 +32,10 @@ def get_target_resolution(width, height, allowed_resolutions):
     new_height = int(round((height * scale_ratio) / 32) * 32)
     return new_width, new_height
 
-def process_video(video_path, output_path, allowed_frame_counts, allowed_resolutions):
+def read_resized_frames(video_path, allowed_frame_counts, allowed_resolutions):
     cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise IOError(f"Could not open video file {video_path}")
     frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
     orig_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
     orig_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
@@ -44,6 +53,14 @@ def process_video(video_path, output_path, allowed_frame_counts, allowed_resolut
         frame = cv2.resize(frame, (target_width, target_height))
         frames.append(frame)
     cap.release()
+    if not frames:
+        raise IOError(f"No frames could be read from {video_path}")
+    return frames, fps, (target_width, target_height)
+
+def process_video(video_path, output_path, allowed_frame_counts, allowed_resolutions):
+    frames, fps, (target_width, target_height) = read_resized_frames(
+        video_path, allowed_frame_counts, allowed_resolutions
+    )
 
     # Write output video
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
@@ -52,27 +69,330 @@ def process_video(video_path, output_path, allowed_frame_counts, allowed_resolut
     for frame in frames:
         out.write(frame)
     out.release()
+    return target_width, target_height, len(frames)
+
+def process_video_ffmpeg(video_path, output_path, allowed_frame_counts, allowed_resolutions,
+                         codec='libx264', crf=18):
+    # Only read container metadata here; ffmpeg does the decode, resize, trim and
+    # encode in a single pass.
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise IOError(f"Could not open video file {video_path}")
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    orig_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    orig_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    cap.release()
+
+    target_frame_count = get_nearest_frame_count(frame_count, allowed_frame_counts)
+    target_width, target_height = get_target_resolution(orig_width, orig_height, allowed_resolutions)
+
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    cmd = [
+        'ffmpeg', '-y', '-v', 'error',
+        '-i', video_path,
+        '-vf', f'scale={target_width}:{target_height}',
+        '-frames:v', str(target_frame_count),
+        '-an',
+        '-c:v', codec,
+        '-crf', str(crf),
+        '-pix_fmt', 'yuv420p',
+        '-movflags', '+faststart',
+        output_path,
+    ]
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed for {video_path}: {result.stderr.strip()}")
+    return target_width, target_height, min(target_frame_count, frame_count)
+
+def hash_file(path, chunk_size=1024 * 1024):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def read_caption(input_dir, video_file):
+    # Prompt for a clip from its sidecar caption (clip.mp4 -> clip.txt), flattened
+    # to a single line since prompt.txt holds one prompt per line
+    caption_path = os.path.join(input_dir, os.path.splitext(video_file)[0] + '.txt')
+    if not os.path.exists(caption_path):
+        return ''
+    with open(caption_path, 'r', encoding='utf-8') as f:
+        return ' '.join(f.read().split())
+
+def _process_clip(video_path, output_path, allowed_frame_counts, allowed_resolutions,
+                  backend='opencv', codec='libx264', crf=18):
+    # Runs in a worker process; report failures back instead of raising so one
+    # bad clip does not abort the whole build. Returns (info, error) where info
+    # holds the converted width, height and frames plus the source sha256.
+    try:
+        if backend == 'ffmpeg':
+            width, height, frames = process_video_ffmpeg(video_path, output_path, allowed_frame_counts,
+                                                         allowed_resolutions, codec=codec, crf=crf)
+        else:
+            width, height, frames = process_video(video_path, output_path, allowed_frame_counts,
+                                                  allowed_resolutions)
+        info = {'width': width, 'height': height, 'frames': frames, 'sha256': hash_file(video_path)}
+        return info, None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}\n{traceback.format_exc()}"
+
+def _load_clip_frames(video_path, staging_path, allowed_frame_counts, allowed_resolutions):
+    # Worker for shard export: writes the final frames as raw (T, H, W, 3) RGB
+    # uint8 bytes to staging_path and returns only their shape, so decoded clips
+    # never travel back through the pool's pipe
+    try:
+        frames, _, _ = read_resized_frames(video_path, allowed_frame_counts, allowed_resolutions)
+        array = np.stack([cv2.cvtColor(frame, cv2.COLOR_BGR2RGB) for frame in frames])
+        del frames
+        array.tofile(staging_path)
+        return list(array.shape), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}\n{traceback.format_exc()}"
+
+def _ordered_results(executor, fn, arg_tuples, window):
+    # Yield results in submission order while keeping at most `window` tasks in
+    # flight, so finished-but-unconsumed results cannot pile up in memory.
+    pending = deque()
+    for args in arg_tuples:
+        pending.append(executor.submit(fn, *args))
+        if len(pending) >= window:
+            yield pending.popleft()
+    while pending:
+        yield pending.popleft()
+
+def _list_videos(input_dir):
+    # Sorted so every output listing comes out in the same order on every run
+    return sorted(
+        f for f in os.listdir(input_dir)
+        if f.endswith(('.mp4', '.avi', '.mov', '.mkv'))
+    )
+
+def _write_errors(output_dir, errors, total):
+    errors_path = os.path.join(output_dir, 'errors.json')
+    if errors:
+        with open(errors_path, 'w') as f:
+            json.dump(errors, f, indent=2)
+        print(f"{len(errors)} of {total} clips failed; see {errors_path}")
+    elif os.path.exists(errors_path):
+        os.remove(errors_path)
+
+def build_bucket_index(entries, min_bucket_size=0, small_buckets='keep'):
+    # Group (name, width, height, frames) entries into (width, height, frames)
+    # buckets. Buckets with fewer than min_bucket_size clips are kept, dropped,
+    # or merged. Merging moves a clip into the largest-frame-count big bucket
+    # with the same resolution and no more frames than the clip has, so the
+    # trainer only has to truncate; clips with no such bucket are dropped.
+    groups = {}
+    for name, width, height, frames in entries:
+        groups.setdefault((width, height, frames), []).append(name)
+
+    dropped = []
+    if min_bucket_size > 1 and small_buckets != 'keep':
+        large = {key: names for key, names in groups.items() if len(names) >= min_bucket_size}
+        for (width, height, frames), names in groups.items():
+            if (width, height, frames) in large:
+                continue
+            targets = [key for key in large if key[:2] == (width, height) and key[2] <= frames]
+            if small_buckets == 'merge' and targets:
+                large[max(targets, key=lambda key: key[2])].extend(names)
+            else:
+                dropped.extend(names)
+        groups = large
+
+    buckets = [
+        {'width': width, 'height': height, 'frames': frames, 'count': len(names), 'videos': names}
+        for (width, height, frames), names in sorted(groups.items())
+    ]
+    return {'buckets': buckets, 'dropped': dropped}
 
-def process_videos(input_dir, output_dir):
+def _write_bucket_index(output_dir, entries, min_bucket_size, small_buckets):
+    index = build_bucket_index(entries, min_bucket_size, small_buckets)
+    with open(os.path.join(output_dir, 'buckets.json'), 'w') as f:
+        json.dump(index, f, indent=2)
+    if index['dropped']:
+        print(f"{len(index['dropped'])} clips in buckets smaller than {min_bucket_size} left out of buckets.json")
+
+def load_shard_sample(dataset_dir, sample):
+    # Zero-copy, read-only (frames, height, width, 3) RGB view of one entry from
+    # the "samples" list in shards/index.json
+    return np.memmap(
+        os.path.join(dataset_dir, 'shards', sample['shard']),
+        dtype=np.uint8, mode='r', offset=sample['offset'], shape=tuple(sample['shape'])
+    )
+
+def export_shards(input_dir, output_dir, workers=None, shard_size=4 * 1024 ** 3,
+                  min_bucket_size=0, small_buckets='keep'):
+    # Decode and resize every clip once and write the frames as raw uint8 arrays
+    # into shard files that dataloaders can np.memmap directly. shards/index.json
+    # maps each sample to its shard, byte offset, shape and prompt. A new shard is
+    # started once the current one would grow past shard_size bytes.
     allowed_frame_counts = [17, 49, 61, 129]
     allowed_resolutions = [512, 768, 960, 1280]
 
+    shards_dir = os.path.join(output_dir, 'shards')
+    staging_dir = os.path.join(shards_dir, 'staging')
+    os.makedirs(staging_dir, exist_ok=True)
+    samples = []
+    errors = []
+    video_files = _list_videos(input_dir)
+
+    shard_index = 0
+    shard_name = f'shard_{shard_index:05d}.bin'
+    shard_file = open(os.path.join(shards_dir, shard_name), 'wb')
+    offset = 0
+
+    window = 2 * (workers or os.cpu_count() or 1)
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # Workers stage each clip's frames in a file named after its position
+            # in video_files; only the shape comes back through the pipe
+            arg_tuples = (
+                (os.path.join(input_dir, f), os.path.join(staging_dir, f'{i:06d}.raw'),
+                 allowed_frame_counts, allowed_resolutions)
+                for i, f in enumerate(video_files)
+            )
+            results = _ordered_results(executor, _load_clip_frames, arg_tuples, window)
+            for i, (video_file, future) in enumerate(
+                    tqdm(zip(video_files, results), total=len(video_files), desc='Exporting shards')):
+                staging_path = os.path.join(staging_dir, f'{i:06d}.raw')
+                try:
+                    shape, error = future.result()
+                except Exception as e:
+                    shape, error = None, f"{type(e).__name__}: {e}"
+                if error:
+                    errors.append({'video': video_file, 'error': error})
+                    if os.path.exists(staging_path):
+                        os.remove(staging_path)
+                    continue
+
+                nbytes = os.path.getsize(staging_path)
+                if offset > 0 and offset + nbytes > shard_size:
+                    shard_file.close()
+                    shard_index += 1
+                    shard_name = f'shard_{shard_index:05d}.bin'
+                    shard_file = open(os.path.join(shards_dir, shard_name), 'wb')
+                    offset = 0
+
+                # Stream the staged frames into the shard in chunks
+                with open(staging_path, 'rb') as staged:
+                    shutil.copyfileobj(staged, shard_file, 16 * 1024 * 1024)
+                os.remove(staging_path)
+                samples.append({
+                    'video': video_file,
+                    'shard': shard_name,
+                    'offset': offset,
+                    'shape': shape,
+                    'prompt': read_caption(input_dir, video_file),
+                })
+                offset += nbytes
+    finally:
+        shard_file.close()
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+    with open(os.path.join(shards_dir, 'index.json'), 'w') as f:
+        json.dump({'dtype': 'uint8', 'layout': 'THWC', 'color': 'RGB', 'samples': samples}, f)
+
+    _write_errors(output_dir, errors, len(video_files))
+    _write_bucket_index(
+        output_dir,
+        [(sample['video'], sample['shape'][2], sample['shape'][1], sample['shape'][0]) for sample in samples],
+        min_bucket_size, small_buckets
+    )
+
+def _load_manifest(output_dir):
+    manifest_path = os.path.join(output_dir, 'manifest.json')
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+def _is_unchanged(entry, video_path, output_path, params):
+    # A clip can be reused when it was converted with the same target parameters
+    # and its source still has the same content. Size and mtime are checked first
+    # so unchanged files are never re-read; only touched files get re-hashed.
+    if entry is None or entry['params'] != params or not os.path.exists(output_path):
+        return False
+    stat = os.stat(video_path)
+    if stat.st_size != entry['size']:
+        return False
+    if stat.st_mtime_ns == entry['mtime_ns']:
+        return True
+    if hash_file(video_path) == entry['sha256']:
+        entry['mtime_ns'] = stat.st_mtime_ns
+        return True
+    return False
+
+def process_videos(input_dir, output_dir, workers=None, backend='opencv', codec='libx264', crf=18,
+                   min_bucket_size=0, small_buckets='keep', incremental=False):
+    allowed_frame_counts = [17, 49, 61, 129]
+    allowed_resolutions = [512, 768, 960, 1280]
+    params = {
+        'allowed_frame_counts': allowed_frame_counts,
+        'allowed_resolutions': allowed_resolutions,
+        'backend': backend,
+        'codec': codec if backend == 'ffmpeg' else 'mp4v',
+        'crf': crf if backend == 'ffmpeg' else None,
+    }
+
     videos_output_dir = os.path.join(output_dir, 'videos')
     os.makedirs(videos_output_dir, exist_ok=True)
-    videos_txt = []
-    prompts_txt = []
+    errors = []
+
+    # manifest.json records, per source clip, what it was converted to and from
+    # what, in videos.txt order. Incremental builds keep that order and append
+    # new clips after it.
+    old_manifest = _load_manifest(output_dir) if incremental else {}
+    available = set(_list_videos(input_dir))
+    video_files = [f for f in old_manifest if f in available]
+    video_files += sorted(available - set(old_manifest))
 
-    for video_file in tqdm(os.listdir(input_dir), desc='Processing videos'):
-        if not video_file.endswith(('.mp4', '.avi', '.mov', '.mkv')):
-            continue
+    manifest = {}
+    to_convert = []
+    for video_file in video_files:
         video_path = os.path.join(input_dir, video_file)
         output_video_path = os.path.join(videos_output_dir, video_file)
+        entry = old_manifest.get(video_file)
+        if _is_unchanged(entry, video_path, output_video_path, params):
+            manifest[video_file] = entry
+        else:
+            to_convert.append(video_file)
+    if incremental:
+        print(f"Reusing {len(video_files) - len(to_convert)} converted clips, converting {len(to_convert)}")
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for video_file in to_convert:
+            video_path = os.path.join(input_dir, video_file)
+            output_video_path = os.path.join(videos_output_dir, video_file)
+            futures.append(executor.submit(
+                _process_clip, video_path, output_video_path, allowed_frame_counts, allowed_resolutions,
+                backend, codec, crf
+            ))
 
-        process_video(video_path, output_video_path, allowed_frame_counts, allowed_resolutions)
+        # Collect in submission order, not completion order
+        for video_file, future in tqdm(zip(to_convert, futures), total=len(futures), desc='Processing videos'):
+            try:
+                info, error = future.result()
+            except Exception as e:
+                # The worker process itself died (e.g. killed by the OOM killer)
+                info, error = None, f"{type(e).__name__}: {e}"
+            if error:
+                errors.append({'video': video_file, 'error': error})
+                continue
 
-        relative_video_path = os.path.relpath(output_video_path, output_dir)
+            stat = os.stat(os.path.join(input_dir, video_file))
+            manifest[video_file] = dict(info, size=stat.st_size, mtime_ns=stat.st_mtime_ns, params=params)
+
+    manifest = {f: manifest[f] for f in video_files if f in manifest}
+    videos_txt = []
+    prompts_txt = []
+    bucket_entries = []
+    for video_file, entry in manifest.items():
+        relative_video_path = os.path.relpath(os.path.join(videos_output_dir, video_file), output_dir)
         videos_txt.append(relative_video_path)
-        prompts_txt.append('')  # Placeholder for prompts
+        prompts_txt.append(read_caption(input_dir, video_file))
+        bucket_entries.append((relative_video_path, entry['width'], entry['height'], entry['frames']))
 
     with open(os.path.join(output_dir, 'videos.txt'), 'w') as f:
         for line in videos_txt:
@@ -82,10 +402,40 @@ def process_videos(input_dir, output_dir):
         for line in prompts_txt:
             f.write(line + '\n')
 
+    with open(os.path.join(output_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+
+    _write_errors(output_dir, errors, len(to_convert))
+    _write_bucket_index(output_dir, bucket_entries, min_bucket_size, small_buckets)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--input_videos_dir', type=str, required=True, help='Path to input video directory')
     parser.add_argument('--output_dataset_dir', type=str, required=True, help='Path to output dataset directory')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of worker processes (default: number of CPUs)')
+    parser.add_argument('--backend', choices=['opencv', 'ffmpeg'], default='opencv',
+                        help='Conversion backend: OpenCV mp4v re-encode, or single-pass ffmpeg (default: opencv)')
+    parser.add_argument('--codec', type=str, default='libx264', help='ffmpeg video codec (ffmpeg backend only)')
+    parser.add_argument('--crf', type=int, default=18, help='ffmpeg constant rate factor (ffmpeg backend only)')
+    parser.add_argument('--format', choices=['mp4', 'shards'], default='mp4',
+                        help='Output format: re-encoded mp4 clips, or pre-decoded memory-mappable frame shards')
+    parser.add_argument('--shard_size_gb', type=float, default=4.0, help='Maximum size of each shard file in GB')
+    parser.add_argument('--min_bucket_size', type=int, default=0,
+                        help='Buckets in buckets.json with fewer clips than this are handled per --small_buckets')
+    parser.add_argument('--small_buckets', choices=['keep', 'drop', 'merge'], default='keep',
+                        help='What to do with buckets smaller than --min_bucket_size (default: keep)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Reuse clips converted by a previous run whose source and settings are unchanged '
+                             '(mp4 format only)')
     args = parser.parse_args()
 
-    process_videos(args.input_videos_dir, args.output_dataset_dir)
+    if args.format == 'shards':
+        export_shards(args.input_videos_dir, args.output_dataset_dir, workers=args.workers,
+                      shard_size=int(args.shard_size_gb * 1024 ** 3),
+                      min_bucket_size=args.min_bucket_size, small_buckets=args.small_buckets)
+    else:
+        process_videos(args.input_videos_dir, args.output_dataset_dir, workers=args.workers,
+                       backend=args.backend, codec=args.codec, crf=args.crf,
+                       min_bucket_size=args.min_bucket_size, small_buckets=args.small_buckets,
+                       incremental=args.incremental)